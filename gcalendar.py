@@ -11,29 +11,65 @@ For usage and help:
 # W0404: *Reimport %r (imported line %s)*
 # pylint: disable=W0404
 from copy import copy
+from cStringIO import StringIO
 from optparse import Option, OptionParser, OptionValueError
-import atom
-import atom.service
+import bisect
+import cPickle
+import csv
+import datetime
 import filecmp
-import gdata.calendar
-import gdata.calendar.service
-import gdata.service
 import getpass
+import gservice
+import heapq
+import itertools
+import json
 import logging
 import netrc
 import os
+import Queue
 import re
-import shutil
-import subprocess
+import socket
 import sys
-import tempfile
+import threading
 import time
-
+# Imported by import_modules() so --help and queries run by the daemon do
+# not pay for them.
+atom = None
+ElementTree = None
+gdata = None
+numpy = None              # Optional, see EventTimes
+shutil = None
+subprocess = None
+tempfile = None
+urllib = None
+
+ARRAY_MIN = 10000         # Fewest events converted with EventTimes
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gcalendar')
+CACHE_VERSION = 4
 CALENDAR_MACRO = 'calendar_account'
-CALENDAR_URL = 'www.google.com/calendar/feeds/default/private/full'
-P_ID = re.compile(r'^http://{url}/(.*)$'.format(url=CALENDAR_URL))
+CALENDAR_FEED = '/calendar/feeds/{user}/private/full'
+DAEMON_SOCKET = os.path.join(CACHE_DIR, 'daemon.sock')
+FETCH_WORKERS = 8         # Most calendars fetched at once
+GD_NS = '{http://schemas.google.com/g/2005}'
+GDATA_VERSION = '2'       # Protocol version, its entries carry gd:etag
+PAGE_SIZE = 250
+PAGE_WORKERS = 4          # Most feed pages requested at once
+P_ID = re.compile(r'^https?://www\.google\.com/calendar/feeds/[^/]+/'
+    r'(?:private/full|events)/(.*)$')
+P_QUERY_TOKEN = re.compile(r'\s*(?:(?P<paren>[()])|(?P<neg>-)?'
+    r'(?:(?P<field>[a-z]+):)?(?:"(?P<phrase>[^"]*)"|(?P<word>[^\s()"]+)))')
+P_WORD = re.compile(r'\w+', re.UNICODE)
+P_WORD_ONLY = re.compile(r'^\w+$', re.UNICODE)
 P_REMINDER = re.compile(r'^(.*) minutes by (.*)$')
+P_TIMESTAMP = re.compile(r'^(\d\d\d\d-\d\d-\d\d)'
+    r'(?:T(\d\d:\d\d:\d\d)(?:[.,]\d+)?(Z|[-+]\d\d:\d\d))?$')
+RECURRENCE_DAYS = 366     # Days around today recurring events are cached for
+SYNC_INTERVAL = 300       # Seconds between daemon syncs
 TMP_DIR = '/tmp/calendar'
+TOTAL_RESULTS = (         # openSearch:totalResults tags, version 1 and 2
+    '{http://a9.com/-/spec/opensearchrss/1.0/}totalResults',
+    '{http://a9.com/-/spec/opensearch/1.1/}totalResults')
 
 logging.basicConfig(level=logging.WARN,
     stream=sys.stdout,
@@ -44,44 +80,135 @@ LOG = logging.getLogger('')
 
 class Calendar():
     """Class representing a Google calendar. """
-    def __init__(self, gd_client=None):
+    # Entry elements holding each event attribute, see set_fields().
+    ENTRY_FIELDS = {
+        'description': 'content',
+        'id': 'id',
+        'reminders': 'gd:when',
+        'until': 'gd:when',
+        'what': 'title',
+        'when': 'gd:when',
+        'where': 'gd:where',
+        }
+    # Event attributes printed by each mode, all if the mode is not listed.
+    MODE_ATTRIBUTES = {
+        'short': ('what', 'when'),
+        }
+
+    def __init__(self, gd_client=None, cache=None, calendar_id='default'):
         self.gd_client = gd_client
-        self.query = gdata.calendar.service.CalendarEventQuery('default',
-            'private', 'full')
-        self.query.max_results = 999999
-        self.feed = None         # Set in get(), query may change
-        self.events = []
-        self.filtered_events = []
+        self.cache = cache       # EventCache instance, None disables caching
+        self.calendar_id = calendar_id  # eg 'default', 'x@gmail.com'
+        self.feed_uri = CALENDAR_FEED.format(user=urllib.quote(calendar_id))
+        self.query = None        # Feed query, None if offline
+        if gdata is not None:
+            self.query = gdata.calendar.service.CalendarEventQuery(
+                calendar_id, 'private', 'full')
+            self.query.orderby = 'starttime'
+            self.query.sortorder = 'ascending'
+        self.feed = None         # Last page fetched, query may change
+        self.page_size = PAGE_SIZE
+        self.page_workers = PAGE_WORKERS
+        self.events = EventStore()
+        self.detached = False    # If True, get() creates read only events
+                                 # without parsing entries with gdata
+        self.resident = False    # If True, get() serves self.events without
+                                 # syncing, see load_resident()
+        self.offline = False     # If True, get() serves the cache without
+                                 # syncing, see --offline
         self.filename = ''
+        self.bak_filename = ''   # Set in edit(), file contents before edit
+        self.sorted_by = 'when'  # Order of events yielded by get()
+        self.write_size = PAGE_SIZE  # Events printed per write
         self.in_fmt = '%Y-%m-%d %H:%M:%S'
         self.start_fmt = '%Y-%m-%dT%H:%M:%S.0500Z'
+        self.from_time = None    # Set in set_query_filters(), in_fmt format
+        self.to_time = None
 
-    def add_blank_event(self):
-        """Adds a blank event using Google's Calendar API
+    def add_event(self, attributes):
+        """Adds an event using Google's Calendar API
+        Args:
+            attributes: dictionary, see event_attributes()
         Returns:
             Event instance, if successful. None, otherwise.
+
+        Notes:
+            The complete event entry is inserted in a single request and the
+            event is appended to the list of events.
         """
-        LOG.debug("Adding blank event.")
+        LOG.debug("Adding event.")
         if not self.gd_client:
             return
-        new_event = gdata.calendar.CalendarEventEntry(title=atom.Title(
-            text='_new_event'))
-        event_entry = None
+        new_event = gdata.calendar.CalendarEventEntry()
+        self.set_entry_attributes(new_event, attributes)
         try:
             event_entry = self.gd_client.InsertEvent(new_event,
-                '/calendar/feeds/default/private/full')
+                self.feed_uri)
         except gdata.service.RequestError, e:
-            msg = 'Add blank event failed'
+            msg = 'Add event failed'
             if 'reason' in e[0]:
                 reason = e[0]['reason']
                 if e[0]['reason'] == 'Conflict':
                     reason = 'event conflicts with existing event'
                 msg = '{msg}: {reason}'.format(msg=msg, reason=reason)
             print >> sys.stderr, msg
-        return Event(entry=event_entry)
+            return
+        event = Event(entry=event_entry)
+        self.events.add(event)
+        return event
+
+    def changeset(self):
+        """Determine the blocks of the edit file that changed.
+        Returns:
+            list of blocks, lists of strings of information data, in the
+            order they appear in the file.
+
+        Notes:
+            Blocks without an id are added events. Blocks with a 'what' of
+            DELETE are deleted events. Blocks whose attributes differ from
+            those of the same id in the backup file are modified events. All
+            other blocks are unchanged and are not included.
+
+            If there is no backup file, all blocks are considered changed.
+        """
+        blocks = list(self.update_generator())
+        if not self.bak_filename:
+            return blocks
+
+        original = {}
+        for info in self.update_generator(filename=self.bak_filename):
+            attributes = self.event_attributes(info)
+            if 'id' in attributes:
+                original[attributes['id']] = attributes
+
+        changed = []
+        counts = {'add': 0, 'delete': 0, 'update': 0}
+        for info in blocks:
+            attributes = self.event_attributes(info)
+            if not attributes:
+                continue
+            action = event_action(attributes)
+            if action == 'update' and \
+                    original.get(attributes['id']) == attributes:
+                continue
+            counts[action] += 1
+            changed.append(info)
+        LOG.info(' '.join([
+            'Changes: added: {add},'.format(add=counts['add']),
+            'modified: {upd},'.format(upd=counts['update']),
+            'deleted: {dlt},'.format(dlt=counts['delete']),
+            'unchanged: {same}'.format(same=len(blocks) - len(changed)),
+            ]))
+        return changed
+
+    def edit(self, events):
+        """Edit calendar events
+        Args:
+            events: iterable of Event instances to edit
+        """
+        # All events in the file are needed when updating.
+        self.events = EventStore(events)
 
-    def edit(self):
-        """Edit calendar events"""
         # Create temp file.
         if not os.path.exists(TMP_DIR):
             os.makedirs(TMP_DIR)
@@ -90,10 +217,8 @@ class Calendar():
         bak_tmp_name = '{tmp}.bak'.format(tmp=tmp_filename)
 
         # Get calendar events into temp file.
-        old_stdout = sys.stdout
-        sys.stdout = open(tmp_filename, 'w')
-        self.print_events()
-        sys.stdout = old_stdout
+        with open(tmp_filename, 'w') as tmp_file:
+            self.print_events(self.events, out=tmp_file)
 
         # Back up file
         # copy2 is used to preserve meta data
@@ -105,6 +230,7 @@ class Calendar():
         # Diff file and backup
         if not filecmp.cmp(tmp_filename, bak_tmp_name):
             self.filename = tmp_filename
+            self.bak_filename = bak_tmp_name
 
     def event_attributes(self, info):
         """Creates a dictionary of event attributes from contents in a file
@@ -151,48 +277,374 @@ class Calendar():
                     attributes[item_key] = item_value
         return attributes
 
-    def filter(self, keyword=None, match_id=None):
+    def execute_batch(self, operations):
+        """Send a set of operations to google calendar as a batch request.
+        Args:
+            operations: list of (index, action, entry) tuples, see
+                update_batch()
+        Returns:
+            list of (index, result, error) tuples. See
+            gservice.map_concurrent() for the result and error values.
+        """
+        feed = gdata.calendar.CalendarEventFeed()
+        actions = {}
+        for index, action, entry in operations:
+            batch_id = str(index)
+            actions[batch_id] = (action, entry_id(entry))
+            if action == 'add':
+                feed.AddInsert(entry=entry, batch_id_string=batch_id)
+            elif action == 'delete':
+                feed.AddDelete(entry=entry, batch_id_string=batch_id)
+            else:
+                feed.AddUpdate(entry=entry, batch_id_string=batch_id)
+        LOG.debug("Sending batch of {count} operations.".format(
+            count=len(operations)))
+        response = self.gd_client.ExecuteBatch(feed,
+            '{uri}/batch'.format(uri=self.feed_uri),
+            converter=gdata.calendar.CalendarEventFeedFromString)
+
+        results = {}
+        for entry in response.entry:
+            if not entry.batch_id or entry.batch_id.text not in actions:
+                continue
+            batch_id = entry.batch_id.text
+            code = int(entry.batch_status.code)
+            if 200 <= code < 300:
+                results[batch_id] = (entry, None)
+                action, event_id = actions[batch_id]
+                if action == 'add':
+                    self.events.add(Event(entry=entry))
+                elif action == 'delete':
+                    self.events.remove(event_id)
+            else:
+                results[batch_id] = (None, 'Status: {code}, {reason}'.format(
+                    code=code, reason=entry.batch_status.reason))
+        statuses = []
+        for index, unused_action, unused_entry in operations:
+            result, error = results.get(str(index),
+                (None, 'No batch status returned.'))
+            statuses.append((index, result, error))
+        return statuses
+
+    def expansion_window(self):
+        """Return the dates a full sync expands recurring events in.
+        Returns:
+            tuple, (start, end) dates, 'yyyy-mm-dd'
+
+        Notes:
+            The window is RECURRENCE_DAYS either side of today, widened to
+            include the query date filters.
+        """
+        today = datetime.date.today()
+        days = datetime.timedelta(days=RECURRENCE_DAYS)
+        start = str(today - days)
+        end = str(today + days)
+        if self.from_time:
+            start = min(start, self.from_time[:10])
+        if self.to_time:
+            end = max(end, self.to_time[:10])
+        return (start, end)
+
+    def feed_entries(self, query, records=False, validators=None):
+        """Generator of the entries of a calendar feed, a page at a time.
+        Args:
+            query: CalendarEventQuery instance
+            records: If True, parse the feed with parse_entries() instead
+                of gdata.
+            validators: dictionary, if not None, the first page is requested
+                with CalendarService.get_conditional() using the validators
+                if they are for the same uri. The dictionary is updated
+                with the uri and validators of the first page.
+        Returns:
+            Generator of CalendarEventEntry instances, or of dictionaries
+            if records is True.
+
+        Notes:
+            The feed is requested in windows of page_size entries using the
+            start-index and max-results parameters. If the first page is
+            full, up to page_workers following pages are requested at once,
+            see map_ahead(), and at most that many pages are held in memory.
+            Only the pages within the openSearch:totalResults of the first
+            page are requested. If a feed has no total, no page is
+            requested once one comes back short.
+            Entries are yielded in feed order. On return, self.feed is the
+            first page, if records is False.
+
+            If the first page is unchanged, a gdata.service.RequestError
+            with status 304 is raised before any entry is yielded.
+        """
+        query.max_results = self.page_size
+        end = threading.Event()     # Set once a page is short
+
+        def page_uris(start_index, total=None):
+            """Generator of the uris of the pages from start_index on, up to
+            total entries if total is not None."""
+            while not end.is_set() and (total is None or
+                    start_index <= total):
+                query.start_index = start_index
+                yield query.ToUri()
+                start_index += self.page_size
+
+        def fetch(uri, validators=None):
+            """Return a tuple (feed, entries, total) of a page of the feed,
+            feed is None if records is True, total is the total number of
+            entries of the feed, None if unknown. See feed_entries() for
+            validators."""
+            LOG.debug("Getting events: {uri}".format(uri=uri))
+            converter = gdata.calendar.CalendarEventFeedFromString
+            if records:
+                converter = StringIO
+            headers = {'GData-Version': GDATA_VERSION}
+            if validators is None:
+                result = self.gd_client.Get(uri, extra_headers=headers,
+                    converter=converter)
+            else:
+                previous = None
+                if validators.get('uri') == uri:
+                    previous = validators
+                result, current = self.gd_client.get_conditional(uri,
+                    validators=previous, converter=converter,
+                    extra_headers=headers)
+                validators.clear()
+                validators.update(current, uri=uri)
+            feed = None
+            total = None
+            if records:
+                info = {}
+                entries = list(parse_entries(result, feed=info))
+                total = info.get('total')
+            else:
+                feed = result
+                entries = feed.entry
+                if feed.total_results and feed.total_results.text:
+                    total = int(feed.total_results.text)
+            if len(entries) < self.page_size:
+                end.set()
+            return (feed, entries, total)
+
+        # Most feeds, eg incremental syncs, fit in one page.
+        feed, entries, total = fetch(page_uris(1).next(),
+            validators=validators)
+        if feed is not None:
+            # The first page has the timestamp of the feed
+            self.feed = feed
+        for entry in entries:
+            yield entry
+        if len(entries) < self.page_size:
+            return
+        for unused_feed, entries, unused_total in map_ahead(fetch,
+                page_uris(1 + self.page_size, total=total),
+                workers=self.page_workers):
+            for entry in entries:
+                yield entry
+            if len(entries) < self.page_size:
+                return
+
+    def filter(self, events, keyword=None, match_id=None, match='regex'):
         """ Filter events keeping only those that qualify.
         Args:
-            keyword: string, keyword to match on
+            events: iterable of Event instances
+            keyword: string, keyword or query to match on
             match_id: string, id to match on
+            match: string, keyword matching mode, one of 'prefix', 'word',
+                'regex'
+        Returns:
+            Generator of Event instances that qualify.
 
         Notes:
-            If a match_id is provided, the keyword is ignored.
-
-            Keyword matching: events which contain the provided keyword in the
-            "what" or "description" are considers a match. Matching is case
-            insensitive. If no keyword is provided all events match.
+            If a match_id is provided and events is an EventStore, the event
+            is looked up by id rather than by scanning the events.
+
+            Keyword matching: By default the keyword is a regular expression
+            matched against the what and description, see Event.is_match().
+            If the match is 'prefix' or 'word', the keyword is compiled into
+            a Query. If the keyword is not a valid query, regex matching is
+            used. Matching is case insensitive. If no keyword is provided
+            all events match.
+
+            If a cache is used, the cache keyword index is used to narrow the
+            events a query is matched against.
         """
         LOG.debug("Filtering events for keyword: {kw}".format(kw=keyword))
 
         if not keyword and not match_id:
             LOG.debug("No keyword or id, no events filtered")
-            self.filtered_events = self.events
+            for event in events:
+                yield event
+            return
+
+        if match_id and isinstance(events, EventStore):
+            event = events.get(match_id)
+            events = []
+            if event:
+                events = [event]
+
+        query = None
+        if keyword and match != 'regex':
+            try:
+                query = Query(keyword, match=match)
+            except ValueError, err:
+                LOG.debug("Using regex match. {reason}".format(
+                    reason=str(err)))
+        if query:
+            ids = None
+            if self.cache is not None:
+                LOG.debug("Searching keyword index.")
+                ids = query.candidates(self.cache.index)
+            for event in events:
+                if match_id and event.id != match_id:
+                    continue
+                if ids is not None and event.id not in ids:
+                    continue
+                if query.is_match(event):
+                    yield event
             return
 
-        self.filtered_events = []
-        for event in self.events:
-            id_match = True
+        for event in events:
             if match_id and event.id != match_id:
-                id_match = False
-            if event.is_match(keyword=keyword) and id_match:
-                self.filtered_events.append(event)
+                continue
+            if event.is_match(keyword=keyword):
+                yield event
+
+    def find_event(self, event_id):
+        """Find an event by id.
+        Args:
+            event_id: string, event id
+        Returns:
+            Event instance, if found. None, otherwise.
+        """
+        return self.events.get(event_id)
 
     def get(self):
-        """Get events from google calendar."""
-        self.feed = self.gd_client.CalendarQuery(self.query)
-        self.events = []
-        for entry in self.feed.entry:
-            event = Event(entry=entry)
-            self.events.append(event)
+        """Get events from google calendar.
+        Returns:
+            Iterable of Event instances.
+
+        Notes:
+            If a cache is used, the cache is synced and all cached events are
+            stored in self.events. An EventStore of the events in range of the
+            query date filters is returned.
+
+            Without a cache, a generator is returned which yields events as
+            each page of the feed arrives. Events are not stored.
 
-    def print_events(self, mode='long', sort_by='when'):
+            If the calendar is resident, the events in self.events are used
+            as they are. The cache is synced by load_resident() instead. If
+            the calendar is offline, the cache is used without syncing.
+
+            In either case events are in order of start time, see
+            self.sorted_by.
+        """
+        if self.cache is None:
+            return self.stream_events()
+        if not self.resident:
+            if not self.offline:
+                self.sync()
+            events = self.load_events()
+            if numpy and len(events) >= ARRAY_MIN:
+                return self.get_bulk(events)
+        return self.events.between(start=self.from_time, end=self.to_time)
+
+    def get_bulk(self, events):
+        """Convert the times of events in bulk.
+        Args:
+            events: list of Event instances
+        Returns:
+            EventStore of events within the query time range sorted by
+            start time. See get().
+        """
+        starts = []
+        ends = []
+        for event in events:
+            start, end = event.timestamps()
+            starts.append(start)
+            ends.append(end)
+        times = EventTimes(starts, ends)
+        for event, when, until in zip(events, times.strings(times.starts),
+                times.strings(times.ends)):
+            event.when, event.until = when, until
+        return EventStore([events[x] for x in
+            times.between(start=self.from_time, end=self.to_time).tolist()])
+
+    def load_events(self):
+        """Create events from the cached entries and store them in
+        self.events.
+        Returns:
+            list of Event instances
+        """
+        events = []
+        for xml in self.cache.entries.itervalues():
+            if self.detached:
+                events.append(Event(record=entry_record(
+                    ElementTree.fromstring(xml))))
+            else:
+                events.append(Event(
+                    entry=gdata.calendar.CalendarEventEntryFromString(xml)))
+        self.events = EventStore(events)
+        return events
+
+    def load_resident(self):
+        """Sync the cache and keep its events in memory for get().
+
+        Notes:
+            Used by the daemon, see Daemon. Events are only recreated if the
+            sync merged entries. Times are converted and the time index is
+            built here so a query only bisects the index.
+        """
+        if not self.sync() and self.resident:
+            return
+        events = self.load_events()
+        if numpy and len(events) >= ARRAY_MIN:
+            self.get_bulk(events)
+        self.events.build_time_index()
+        self.resident = True
+
+    def ordered(self, events, sort_by='when', limit=None):
+        """Return events in sort_by order.
+        Args:
+            events: iterable of Event instances
+            sort_by: string, attribute to sort events by
+            limit: integer, return at most this many events, None for all
+        Returns:
+            Iterable of Event instances.
+
+        Notes:
+            If the events are already in sort_by order (see get()), events
+            with a start time are returned as they arrive and events without
+            one are held back and returned last, as event_sort_key() orders
+            them. Otherwise events are sorted by event_sort_key(). With a
+            limit, the first events are selected with a heap of limit events
+            instead of sorting them all.
+        """
+        key = lambda x: event_sort_key(x, sort_by)
+        if sort_by == self.sorted_by:
+            def untimed_last():
+                """Generator of the events, those without a start time
+                last."""
+                untimed = []
+                for event in events:
+                    if event.when:
+                        yield event
+                    else:
+                        untimed.append(event)
+                for event in sorted(untimed, key=key):
+                    yield event
+            return itertools.islice(untimed_last(), limit)
+        if limit is not None:
+            return heapq.nsmallest(limit, events, key=key)
+        return sorted(events, key=key)
+
+    def print_events(self, events, mode='long', sort_by='when', limit=None,
+            out=None):
         """ Print events.
         Args:
-            mode: string, print format mode, one of 'long', 'short'
+            events: iterable of Event instances
+            mode: string, print format mode, one of 'long', 'short',
+                'jsonl', 'csv', 'ics'
             sort_by: string, attribute to sort events by, one of
                 'id', 'what', 'where', 'when', 'until', 'description'
+            limit: integer, print at most this many events, None for all
+            out: file object to print to, default sys.stdout
 
         Example output:
 
@@ -209,136 +661,100 @@ class Calendar():
 
         2010-01-03 10:00:00 Blades hockey game
 
-        """
-        printable_item = []
-        for event in self.filtered_events:
-            # The tilde char sorts after alpha numeric characters. By
-            # defaulting the sort key to start with tilde, any events without a
-            # value in the sort_by field will sort to the end of the list.
-            # The event.id is appended to the sort key so that each key is
-            # unique. This will enforce a specific order so results will always
-            # be consistent.
-            sort_key = ''.join(('~n/a~', event.id))
-            if sort_by and getattr(event, sort_by):
-                sort_key = str(getattr(event, sort_by)).lower()
-            e = {
-                    'id': event.id,
-                    'what': event.what,
-                    'when': event.when,
-                    'until': event.until,
-                    'where': event.where,
-                    'description': event.description,
-                    'sort_key': sort_key,
-                    'reminders': event.reminders,
-                    }
-            printable_item.append(e)
-
-        cmp_fn = lambda x, y: cmp(x['sort_key'], y['sort_key'])
-
-        for printable in sorted(printable_item, cmp=cmp_fn):
-            if mode == 'short':
-                print '{when}\t{what}'.format(when=printable['when'],
-                    what=printable['what'])
-            else:
-                print ""
-                fields = ['id', 'what', 'when', 'until', 'where',
-                    'description']
-                for field in fields:
-                    if printable[field]:
-                        print '{field}: {prt}'.format(field=field,
-                            prt=printable[field])
-                if printable['reminders']:
-                    for reminder in printable['reminders']:
-                        print 'remind: {rem}'.format(rem=reminder)
-
-    def set_query_filters(self, from_date=None, to_date=None):
-        """Set query filters.
-        Args:
-            from_date, string, date, 'yyyy-mm-dd'
-            to_date, string, date, 'yyyy-mm-dd'
-        """
-        if from_date:
-            dt = time.strptime("{date} 00:00:00".format(date=from_date),
-                self.in_fmt)
-        else:
-            dt = time.localtime()       # Today
-        self.query.start_min = time.strftime(self.start_fmt,
-            time.gmtime(time.mktime(dt)))
+        ## Mode: jsonl
 
-        if to_date:
-            dt = time.strptime("{date} 23:59:59".format(date=to_date),
-                self.in_fmt)
-            self.query.start_max = time.strftime(self.start_fmt,
-                time.gmtime(time.mktime(dt)))
+        {"id": "8d3g6ifa8qbdjpi74vv34i5s8s", "what": "Blades hockey game", ...}
 
-    def update(self):
-        """Update events from file. """
-        if not self.filename:
-            return
-        for info in self.update_generator():
-            if not self.update_event(info):
-                print >> sys.stderr, 'Calendar event update failed:'
-                print >> sys.stderr, info
-        return
+        ## Mode: csv
 
-    def update_event(self, info):
-        """Update calendar event with provided information.
+        id,what,when,until,where,description,reminders
+        8d3g6ifa8qbdjpi74vv34i5s8s,Blades hockey game,2010-01-03 10:00:00,...
 
-        Args:
-            info: list, list of strings of information data
-        """
-        attributes = self.event_attributes(info)
-        if not attributes:
-            return
-
-        action = None
-        if 'id' in attributes.keys():
-            if 'what' in attributes.keys() and attributes['what'] == 'DELETE':
-                action = 'delete'
-            else:
-                action = 'update'
-        else:
-            action = 'add'
-
-        if action == 'add':
-            # Add a blank event and then continue as if updating.
-            event = self.add_blank_event()
-            self.events.append(event)
-            if event.entry.id:
-                match = P_ID.match(event.entry.id.text)
-                if match:
-                    attributes['id'] = match.group(1)
-            action = 'update'
-
-        # Find the matching event
-        event = None
-        for e in self.events:
-            match = P_ID.match(e.entry.id.text)
-            if match:
-                if attributes['id'] == match.group(1):
-                    event = e
-        if not event:
-            return
+        ## Mode: ics, see format_ics().
 
-        label = ''
-        if 'what' in attributes:
-            label = attributes['what']
-        elif 'description' in attributes:
-            label = attributes['description']
-        else:
-            label = attributes['id']
-        action_labels = {
-            'add': 'Adding',
-            'delete': 'Deleting',
-            'update': 'Updating',
-            }
-        LOG.info("{action}: {label}".format(action=action_labels[action],
-                label=label))
+        Notes:
+            See ordered() for the order events are printed in. Output is
+            written and flushed write_size events at a time so events
+            streamed from the feed are printed a page at a time.
+        """
+        if out is None:
+            out = sys.stdout
+        format_event = PRINT_MODES[mode]
+        lines = [PRINT_HEADERS.get(mode, '')]
+        count = 0
+        for event in self.ordered(events, sort_by=sort_by, limit=limit):
+            lines.append(format_event(event))
+            count += 1
+            if count % self.write_size == 0:
+                out.write(''.join(lines))
+                out.flush()
+                lines = []
+        lines.append(PRINT_FOOTERS.get(mode, ''))
+        out.write(''.join(lines))
+        out.flush()
+
+    def put_event(self, entry):
+        """Send an updated event entry to google calendar.
+        Args:
+            entry: CalendarEventEntry instance
+        Returns:
+            CalendarEventEntry instance, the entry as updated by google.
+        Raises:
+            gdata.service.RequestError, status 409 or 412 if the event was
+            changed since entry was fetched.
 
-        if action == 'delete':
-            return self.gd_client.DeleteEvent(event.entry.GetEditLink().href)
+        Notes:
+            The entry is sent conditional on its etag, if it has one, see
+            refresh_event().
+        """
+        headers = {'GData-Version': GDATA_VERSION}
+        if entry_etag(entry):
+            headers['If-Match'] = entry_etag(entry)
+        return self.gd_client.Put(entry, entry.GetEditLink().href,
+            extra_headers=headers,
+            converter=gdata.calendar.CalendarEventEntryFromString)
+
+    def refresh_event(self, event):
+        """Get the current version of an event from google calendar.
+        Args:
+            event: Event instance, with an entry
+        Returns:
+            Event instance, the current version, or event if it is
+            unchanged.
 
+        Notes:
+            Feeds and entries are requested in version 2 of the protocol,
+            whose entries carry a gd:etag, see GDATA_VERSION. The request
+            is conditional on the etag of the entry, so an unchanged event
+            costs a 304 reply. A changed event replaces event in
+            self.events and in the cache.
+        """
         entry = event.entry
+        link = entry.GetSelfLink() or entry.GetEditLink()
+        try:
+            current, unused_validators = self.gd_client.get_conditional(
+                link.href, validators={'etag': entry_etag(entry)},
+                converter=gdata.calendar.CalendarEventEntryFromString,
+                extra_headers={'GData-Version': GDATA_VERSION})
+        except gdata.service.RequestError, error:
+            if error.args[0]['status'] != 304:
+                raise
+            return event
+        refreshed = Event(entry=current)
+        refreshed.calendar = event.calendar
+        self.events.add(refreshed)
+        if self.cache is not None:
+            self.cache.merge([current])
+        return refreshed
+
+    def set_entry_attributes(self, entry, attributes):
+        """Set the properties of an event entry from event attributes.
+        Args:
+            entry: CalendarEventEntry instance
+            attributes: dictionary, see event_attributes()
+        """
+        # R0201: *Method could be a function*
+        # pylint: disable=R0201
         entry.title = None
         if 'what' in attributes:
             entry.title = atom.Title(text=attributes['what'])
@@ -383,26 +799,325 @@ class Calendar():
         if 'description' in attributes:
             entry.content = atom.Content(text=attributes['description'])
 
-        result = None
-        for unused_count in range(1, 15):
-            try:
-                result = self.gd_client.UpdateEvent(entry.GetEditLink().href,
-                    entry)
-            except gdata.service.RequestError, error:
-                e = error.args[0]
-                LOG.error("RequestError: " + time.strftime(
-                        '%Y-%m-%d %H:%M:%S', time.localtime()))
-                LOG.error("Status: %s, %s" % (e['status'], e['reason']))
-                LOG.error("Pausing a few seconds before trying again.")
-                time.sleep(1)
+    def set_fields(self, mode='long', keyword=None, sort_by='when'):
+        """Set the entry fields requested by the feed query.
+        Args:
+            mode: string, print format mode, see print_events()
+            keyword: string, keyword or query the events are filtered on
+            sort_by: string, attribute to sort events by
+        Notes:
+            The fields parameter asks google for a partial feed, with only
+            the entry elements of the event attributes printed, filtered
+            and sorted on. Only detached events without a cache are
+            requested partially, cached and editable entries are complete.
+        """
+        self.query.pop('fields', None)
+        if self.cache is not None or not self.detached:
+            return
+        attributes = set(self.MODE_ATTRIBUTES.get(mode, self.ENTRY_FIELDS))
+        attributes.update(['id', 'when', sort_by])
+        if keyword:
+            attributes.update(Query.DEFAULT_FIELDS + ('reminders',))
+        fields = sorted(set([self.ENTRY_FIELDS[x] for x in attributes]))
+        # The total number of entries limits the pages requested.
+        self.query['fields'] = 'openSearch:totalResults,entry({flds})'.format(
+            flds=','.join(fields))
+
+    def set_query_filters(self, from_date=None, to_date=None, days=None):
+        """Set query filters.
+        Args:
+            from_date, string, date, 'yyyy-mm-dd'
+            to_date, string, date, 'yyyy-mm-dd'
+            days, integer, number of days from the from_date. If provided,
+                to_date is ignored.
+        """
+        if from_date:
+            dt = time.strptime("{date} 00:00:00".format(date=from_date),
+                self.in_fmt)
+        else:
+            dt = time.localtime()       # Today
+        start_min = time.strftime(self.start_fmt,
+            time.gmtime(time.mktime(dt)))
+        self.from_time = time.strftime(self.in_fmt, dt)
+
+        # Filters of a previous query do not carry over, see Daemon.
+        start_max = None
+        self.to_time = None
+        if days:
+            # mktime normalizes the day of month
+            to_date = time.strftime('%Y-%m-%d', time.localtime(time.mktime(
+                (dt[0], dt[1], dt[2] + days - 1, 0, 0, 0, 0, 0, -1))))
+        if to_date:
+            dt = time.strptime("{date} 23:59:59".format(date=to_date),
+                self.in_fmt)
+            start_max = time.strftime(self.start_fmt,
+                time.gmtime(time.mktime(dt)))
+            self.to_time = time.strftime(self.in_fmt, dt)
+
+        if self.query is None:
+            return
+        self.query.start_min = start_min
+        self.query.pop('start-max', None)
+        if start_max:
+            self.query.start_max = start_max
+
+    def set_text_query(self, keyword=None, match='regex'):
+        """Set the full text query of the feed query from a keyword.
+        Args:
+            keyword: string, keyword or query the events are filtered on
+            match: string, keyword matching mode, see filter()
+        Notes:
+            Google matches the q parameter against whole words, so only
+            'word' matching is pushed down, and only the words all matching
+            events contain, see Query.text_query(). The server returns a
+            superset of the matching events and filter() still matches the
+            keyword exactly. The cache is synced with the full feed so no
+            text query is set with a cache.
+        """
+        self.query.pop('q', None)
+        if not keyword or match != 'word' or self.cache is not None:
+            return
+        try:
+            text = Query(keyword, match=match).text_query()
+        except ValueError:
+            return
+        if text:
+            LOG.debug("Text query: {q}".format(q=text))
+            self.query.text_query = text
+
+    def stream_events(self):
+        """Generator of events from the calendar feed.
+        Returns:
+            Generator of Event instances.
+        """
+        for item in self.feed_entries(self.query, records=self.detached):
+            if self.detached:
+                yield Event(record=item)
+            else:
+                yield Event(entry=item)
+
+    def sync(self):
+        """Sync the event cache with google calendar.
+        Returns:
+            integer, number of entries merged into the cache
+
+        Notes:
+            The first sync fetches the full calendar feed. Subsequent syncs
+            request only entries updated since the last sync, including
+            deleted entries, and merge them into the cache. The request is
+            conditional on the validators of the last sync, so if nothing
+            has changed the server replies 304 Not Modified and the cache
+            is left as it is.
+
+            Recurring events are cached as their occurrences, expanded by
+            google within the expansion_window() of the last full sync, so
+            each occurrence has a start time. If the query date filters
+            fall outside the window, or today is less than half of
+            RECURRENCE_DAYS from its end, the cache is fetched again with a
+            new window.
+        """
+        if self.cache.synced:
+            start, end = self.cache.expansion
+            today = datetime.date.today()
+            horizon = str(today + datetime.timedelta(
+                days=RECURRENCE_DAYS // 2))
+            if (self.from_time and self.from_time[:10] < start) or \
+                    (self.to_time and self.to_time[:10] > end) or \
+                    horizon > end:
+                LOG.info("Query outside of cached recurring events,"
+                    " fetching all events.")
+                self.cache.clear()
+        expansion = self.cache.expansion or self.expansion_window()
+        query = gdata.calendar.service.CalendarEventQuery(self.calendar_id,
+            'private', 'full')
+        query.singleevents = 'true'
+        query.recurrence_expansion_start = expansion[0]
+        query.recurrence_expansion_end = expansion[1]
+        if self.cache.synced:
+            LOG.debug("Syncing events updated since: {upd}".format(
+                upd=self.cache.synced))
+            query.updated_min = self.cache.synced
+            query['showdeleted'] = 'true'
+        else:
+            LOG.debug("Fetching all events for cache.")
+        synced = self.cache.synced
+        validators = dict(self.cache.validators)
+        entries = self.feed_entries(query, validators=validators)
+        try:
+            # Fetch the first page to find out if the query is acceptable.
+            first_entry = next(entries, None)
+        except gdata.service.RequestError, error:
+            e = error.args[0]
+            if e['status'] == 304:
+                LOG.debug("No events updated since last sync.")
+                return 0
+            if not self.cache.synced:
+                raise
+            # The server refuses updated-min values that are too old.
+            # Fall back to a full fetch.
+            LOG.info("Incremental sync failed, {status} {reason}.".format(
+                status=e['status'], reason=e['reason']))
+            self.cache.clear()
+            return self.sync()
+        if not synced:
+            self.cache.clear()
+        merged = 0
+        if first_entry is not None:
+            merged += self.cache.merge([first_entry])
+        merged += self.cache.merge(entries)
+        if self.feed.updated and self.feed.updated.text:
+            self.cache.synced = self.feed.updated.text
+        self.cache.validators = validators
+        self.cache.expansion = expansion
+        self.cache.save()
+        return merged
+
+    def update(self, workers=1, batch_size=0):
+        """Update events from file.
+        Args:
+            workers: integer, number of events, or batches, to update
+                concurrently.
+            batch_size: integer, if non-zero, events are updated with batch
+                requests of up to this many events.
+
+        Notes:
+            Failures are reported per event in the order the events appear
+            in the file, followed by a summary.
+        """
+        if not self.filename:
+            return
+        blocks = self.changeset()
+        if batch_size > 0:
+            results = self.update_batch(blocks, batch_size, workers=workers)
+        else:
+            results = gservice.map_concurrent(self.update_event, blocks,
+                workers=workers)
+
+        counts = {'add': 0, 'delete': 0, 'update': 0, 'failed': 0}
+        for info, (result, error) in zip(blocks, results):
+            if error or not result:
+                counts['failed'] += 1
+                print >> sys.stderr, 'Calendar event update failed:'
+                if error:
+                    print >> sys.stderr, error
+                print >> sys.stderr, info
+                continue
+            counts[event_action(self.event_attributes(info))] += 1
+        LOG.info(' '.join([
+            'Added: {add},'.format(add=counts['add']),
+            'updated: {upd},'.format(upd=counts['update']),
+            'deleted: {dlt},'.format(dlt=counts['delete']),
+            'failed: {fail}'.format(fail=counts['failed']),
+            ]))
+        if counts['failed']:
+            msg = '{fail} of {total} calendar event updates failed.'.format(
+                fail=counts['failed'], total=len(blocks))
+            print >> sys.stderr, msg
+        return
+
+    def update_batch(self, blocks, batch_size, workers=1):
+        """Update calendar events using batch requests.
+        Args:
+            blocks: list of lists of strings of information data
+            batch_size: integer, maximum number of events per batch request
+            workers: integer, number of batch requests to send concurrently
+        Returns:
+            list of (result, error) tuples in the order of blocks, see
+            gservice.map_concurrent().
+
+        Notes:
+            New events are inserted complete, in a single operation. The
+            batch id of each operation is the index of its block so batch
+            statuses can be mapped back to blocks.
+        """
+        results = [(None, None)] * len(blocks)
+        operations = []
+        for index, info in enumerate(blocks):
+            attributes = self.event_attributes(info)
+            if not attributes:
+                continue
+            action = event_action(attributes)
+            if action == 'add':
+                entry = gdata.calendar.CalendarEventEntry()
+            else:
+                event = self.find_event(attributes['id'])
+                if not event:
+                    continue
+                entry = event.entry
+            log_action(action, attributes)
+            if action != 'delete':
+                self.set_entry_attributes(entry, attributes)
+            operations.append((index, action, entry))
+
+        batches = []
+        for start in range(0, len(operations), batch_size):
+            batches.append(operations[start:start + batch_size])
+        batch_results = gservice.map_concurrent(self.execute_batch, batches,
+            workers=workers)
+        for batch, (statuses, error) in zip(batches, batch_results):
+            if error:
+                # The whole batch request failed.
+                statuses = [(x[0], None, error) for x in batch]
+            for index, result, error in statuses:
+                results[index] = (result, error)
+        return results
+
+    def update_event(self, info):
+        """Update calendar event with provided information.
+
+        Args:
+            info: list, list of strings of information data
+        """
+        attributes = self.event_attributes(info)
+        if not attributes:
+            return
+
+        action = event_action(attributes)
+
+        if action == 'add':
+            log_action(action, attributes)
+            event = self.add_event(attributes)
+            if not event:
+                return
+            return event.entry
+
+        event = self.find_event(attributes['id'])
+        if not event:
+            return
+
+        log_action(action, attributes)
+
+        if action == 'delete':
+            result = self.gd_client.DeleteEvent(event.entry.GetEditLink().href)
             if result:
-                break
-        return result
+                self.events.remove(event.id)
+            return result
 
-    def update_generator(self):
-        """Generator bundling lines of info for a single calendar"""
+        entry = event.entry
+        self.set_entry_attributes(entry, attributes)
+
+        # Throttled requests are retried by the client, see Governor.
+        try:
+            return self.put_event(entry)
+        except gdata.service.RequestError, error:
+            if error.args[0]['status'] not in (409, 412):
+                raise
+        # The event was changed since it was fetched. Apply the update to
+        # the current version.
+        LOG.info("Update conflict, refreshing event: {id}".format(
+            id=event.id))
+        event = self.refresh_event(event)
+        entry = event.entry
+        self.set_entry_attributes(entry, attributes)
+        return self.put_event(entry)
+
+    def update_generator(self, filename=None):
+        """Generator bundling lines of info for a single calendar
+        Args:
+            filename: string, name of file, defaults to self.filename
+        """
         lines = []
-        with open(self.filename) as f:
+        with open(filename or self.filename) as f:
             for line in f:
                 if len(line.strip()) == 0:
                     if len(lines) > 0:
@@ -414,38 +1129,295 @@ class Calendar():
                 yield lines
 
 
-class Event():
+# Defined by import_modules().
+CalendarService = None
+
+
+class Daemon():
+    """Class representing a resident server of calendar queries.
+
+    The daemon keeps an authenticated client and the events of each
+    calendar queried in memory, syncs them every interval seconds, and
+    serves read only queries from thin clients, see daemon_query(), over a
+    unix socket.
+
+    Protocol: The client sends its command line arguments as a JSON list on
+    one line. The daemon replies with a status line, 'ok' followed by the
+    printed events, or 'fallback' if the client should run the query
+    itself.
+    """
+    def __init__(self, gd_client, email, default_account=True,
+            refresh=False, socket_path=DAEMON_SOCKET,
+            interval=SYNC_INTERVAL):
+        self.gd_client = gd_client
+        self.email = email
+        self.default_account = default_account  # If True, serve queries
+                                                # without --account
+        self.refresh = refresh       # If True, caches are rebuilt
+        self.socket_path = socket_path
+        self.interval = interval
+        self.calendars = {}          # Resident Calendar instances by id
+        self.lock = threading.Lock()
+
+    def accepts(self, options):
+        """Return True if the daemon can run the query of the options.
+        Args:
+            options: optparse Values, options of the query
+        Returns:
+            boolean
+        """
+        if options.edit or options.list_calendars or options.daemon:
+            return False
+        if not options.cache or options.refresh:
+            return False
+        if options.account:
+            return options.account == self.email
+        return self.default_account
+
+    def calendar(self, calendar_id):
+        """Return the resident calendar, loading it on first use.
+        Args:
+            calendar_id: string, calendar id
+        Returns:
+            Calendar instance
+        """
+        calendar = self.calendars.get(calendar_id)
+        if calendar is None:
+            LOG.info("Loading calendar {cal}.".format(cal=calendar_id))
+            cache = EventCache(filename=cache_filename(self.email,
+                calendar_id))
+            if not self.refresh:
+                cache.load()
+            calendar = Calendar(gd_client=self.gd_client, cache=cache,
+                calendar_id=calendar_id)
+            calendar.detached = True
+            calendar.load_resident()
+            self.calendars[calendar_id] = calendar
+        return calendar
+
+    def handle(self, connection):
+        """Serve a query from a client.
+        Args:
+            connection: socket object, connection to the client
+        """
+        reader = connection.makefile('rb')
+        writer = connection.makefile('wb')
+        try:
+            try:
+                # JSON strings load as unicode, the options and keywords
+                # are matched as utf-8 strings.
+                argv = [x.encode('utf-8') for x in
+                    json.loads(reader.readline())]
+                (options, args) = option_parser().parse_args(argv)
+            # optparse exits on invalid options.
+            except (AttributeError, SystemExit, TypeError, ValueError):
+                options = None
+            calendar, events = None, None
+            if options and self.accepts(options):
+                try:
+                    calendar, events = self.query(options, args)
+                # W0703: *Catch "Exception"*
+                # pylint: disable=W0703
+                except Exception, err:
+                    LOG.error("Query failed. {reason}".format(
+                        reason=str(err)))
+            if events is None:
+                writer.write('fallback\n')
+                return
+            writer.write('ok\n')
+            calendar.print_events(events, mode=options.mode,
+                sort_by=options.sort, limit=options.limit, out=writer)
+        except socket.error, err:
+            # The client went away, eg output piped to head.
+            LOG.debug("Client connection lost. {reason}".format(
+                reason=str(err)))
+        finally:
+            try:
+                writer.close()
+            except socket.error:
+                pass
+            reader.close()
+            connection.close()
+
+    def query(self, options, args):
+        """Return the events of a query.
+        Args:
+            options: optparse Values, options of the query
+            args: list of strings, query keyword arguments
+        Returns:
+            tuple, (calendar, events), Calendar instance to print the events
+            with and list of Event instances
+
+        Notes:
+            The events are selected with the lock held so a sync does not
+            change them underfoot. They are printed without it so a slow
+            client does not hold up other queries.
+        """
+        keyword = None
+        if len(args) > 0:
+            keyword = ' '.join(args)
+        with self.lock:
+            calendars = []
+            for calendar_id in options.calendars or ['default']:
+                calendar = self.calendar(calendar_id)
+                calendar.set_query_filters(from_date=options.from_date,
+                    to_date=options.to_date, days=options.days)
+                calendars.append(calendar)
+            if len(calendars) > 1:
+                events = fetch_calendars(calendars, keyword=keyword,
+                    match_id=options.id, match=options.match)
+            else:
+                events = calendar.filter(calendar.get(), keyword=keyword,
+                    match_id=options.id, match=options.match)
+            return (calendar, list(events))
+
+    def serve(self, calendar_ids=None):
+        """Load calendars and serve queries until interrupted.
+        Args:
+            calendar_ids: list of calendar ids to load up front, default
+                ['default']
+        """
+        if daemon_running(self.socket_path):
+            raise SystemExit('A daemon is already running.')
+        for calendar_id in calendar_ids or ['default']:
+            self.calendar(calendar_id)
+        socket_dir = os.path.dirname(self.socket_path)
+        if not os.path.exists(socket_dir):
+            os.makedirs(socket_dir, 0700)
+        if os.path.exists(self.socket_path):
+            # Left behind by a daemon that did not exit cleanly.
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        server.listen(5)
+
+        thread = threading.Thread(target=self.sync_loop)
+        thread.daemon = True
+        thread.start()
+        LOG.info("Serving queries on {path}.".format(path=self.socket_path))
+        try:
+            while True:
+                connection = server.accept()[0]
+                thread = threading.Thread(target=self.handle,
+                    args=(connection, ))
+                thread.daemon = True
+                thread.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+
+    def sync_loop(self):
+        """Sync the resident calendars every interval seconds."""
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                for calendar in self.calendars.values():
+                    try:
+                        calendar.load_resident()
+                    # W0703: *Catch "Exception"*
+                    # pylint: disable=W0703
+                    except Exception, err:
+                        LOG.error("Sync of {cal} failed. {reason}".format(
+                            cal=calendar.calendar_id, reason=str(err)))
+
+
+class Event(object):
     """
     This class pseudo extends gdata.calendar.CalendarEventEntry. The entry
     property points to a CalendarEventEntry object.
+
+    The id, what, when, until, where, description and reminders properties
+    are derived from the entry on first access. A detached event has no
+    entry, only the properties, so it uses a fraction of the memory. It can
+    be printed and filtered but not updated or deleted. An event created
+    from a record of parse_entries() is detached.
     """
     # C0103: *Invalid name "%s" (should match %s)*
     # pylint: disable=C0103
-    def __init__(self, entry=None):
-        self.entry = entry
-        self.id = None
-        self.set_id()
-        self.what = self.entry.title.text
-        self.when = None
-        self.until = None
-        self.set_when()
-        self.where = None
-        self.set_where()
-        self.description = self.entry.content.text
-        self.reminders = []
-        self.set_reminders()
+    __slots__ = ('entry', 'calendar', '_id', '_what', '_when', '_until',
+        '_where', '_description', '_reminders', '_start', '_end')
 
-    def format_time(self, timestamp):
-        """
-        Convert time from google format, eg '2010-01-03T10:00:00.000-05:00'
-        to our format yyyy-mm-dd hh:mm:ss
+    # Value of a property not yet derived from the entry.
+    unset = object()
 
-        """
-        # R0201: *Method could be a function*
-        # pylint: disable=R0201
-        datetime_fmt = '%Y-%m-%d %H:%M:%S'
-        iso8601 = Iso8601(timestamp=timestamp)
-        return time.strftime(datetime_fmt, time.localtime(iso8601.parse()))
+    def __init__(self, entry=None, record=None):
+        self.entry = entry
+        self.calendar = None     # Calendar id, set if several are fetched
+        self._id = self.unset
+        self._what = self.unset
+        self._when = self.unset
+        self._until = self.unset
+        self._where = self.unset
+        self._description = self.unset
+        self._reminders = self.unset
+        self._start = None       # Timestamps of a record until converted
+        self._end = None
+        if record:
+            self.set_record(record)
+
+    @property
+    def description(self):
+        """The event description, the content of the entry."""
+        if self._description is self.unset:
+            self._description = self.entry.content.text
+        return self._description
+
+    @property
+    def id(self):
+        """The event id, eg 'h1vqotvj45rmkaf86rr7cru8cc'."""
+        if self._id is self.unset:
+            self.set_id()
+        return self._id
+
+    @property
+    def reminders(self):
+        """List of reminder strings, eg '10 minutes by email'."""
+        if self._reminders is self.unset:
+            self.set_reminders()
+        return self._reminders
+
+    @property
+    def until(self):
+        """The event end time, yyyy-mm-dd hh:mm:ss."""
+        if self._until is self.unset:
+            self.set_when()
+        return self._until
+
+    @until.setter
+    def until(self, value):
+        """Set the end time, eg if converted in bulk, see EventTimes."""
+        self._until = value
+        self._end = None
+
+    @property
+    def what(self):
+        """The event title."""
+        if self._what is self.unset:
+            self._what = self.entry.title.text
+        return self._what
+
+    @property
+    def when(self):
+        """The event start time, yyyy-mm-dd hh:mm:ss."""
+        if self._when is self.unset:
+            self.set_when()
+        return self._when
+
+    @when.setter
+    def when(self, value):
+        """Set the start time, eg if converted in bulk, see EventTimes."""
+        self._when = value
+        self._start = None
+
+    @property
+    def where(self):
+        """The event location."""
+        if self._where is self.unset:
+            self.set_where()
+        return self._where
 
     def is_match(self, keyword=None):
         """Determine if event is a match for keyword.
@@ -454,29 +1426,42 @@ class Event():
         Returns:
             True if event is a match.
         Notes:
-            The keyword is matched againse the event what and description.
-            Matching is case insensitive.
+            The keyword is a regular expression matched againse the event
+            what and description. Matching is case insensitive.
         """
         if not keyword:
             return True
+        keyword_re = re.compile(keyword, re.IGNORECASE)
         match = False
         if self.what:
-            if re.search(keyword, self.what, re.IGNORECASE):
+            if keyword_re.search(self.what):
                 match = True
         if self.description:
-            if re.search(keyword, self.description, re.IGNORECASE):
+            if keyword_re.search(self.description):
                 match = True
         return match
 
     def set_id(self):
         """Set the id property of the event instance. """
-        if self.entry.id:
-            match = P_ID.match(self.entry.id.text)
-            if match:
-                self.id = match.group(1)
+        self._id = entry_id(self.entry)
+
+    def set_record(self, record):
+        """Set the properties of the event instance from a record.
+        Args:
+            record: dictionary, see parse_entries()
+        """
+        self.entry = None
+        self._id = record['id']
+        self._what = record['what']
+        self._description = record['description']
+        self._where = record['where']
+        self._reminders = record['reminders']
+        self._start = record['start']
+        self._end = record['end']
 
     def set_reminders(self):
         """Set the reminders property of the event instance."""
+        self._reminders = []
         if not self.entry.when:
             return
         if not len(self.entry.when) > 0:
@@ -488,23 +1473,439 @@ class Event():
         for reminder in self.entry.when[0].reminder:
             method = reminder.method
             minutes = reminder.minutes
-            self.reminders.append('{min} minutes by {method}'.format(
+            self._reminders.append('{min} minutes by {method}'.format(
                     min=minutes, method=method))
 
     def set_when(self):
-        """Set the when property of the event instance."""
+        """Set the when and until properties of the event instance."""
+        self._when = None
+        self._until = None
+        if self.entry is None:
+            if self._start:
+                self._when, self._until = TIMESTAMPS.convert_all([
+                    self._start, self._end])
+            self._start = None
+            self._end = None
+            return
         if not self.entry.when:
             return
         if not len(self.entry.when) > 0:
             return
-        self.when = self.format_time(self.entry.when[0].start_time)
-        self.until = self.format_time(self.entry.when[0].end_time)
+        self._when, self._until = TIMESTAMPS.convert_all([
+            self.entry.when[0].start_time, self.entry.when[0].end_time])
 
     def set_where(self):
         """Set the where property of the event instance."""
+        self._where = None
         if self.entry.where:
             if len(self.entry.where) > 0:
-                self.where = self.entry.where[0].value_string
+                self._where = self.entry.where[0].value_string
+
+    def timestamps(self):
+        """Return the google start and end timestamps of the event.
+        Returns:
+            tuple, (start, end), eg ('2010-01-03T10:00:00.000-05:00', ...).
+            (None, None) if the event has no time or it is converted.
+        """
+        if self.entry is None:
+            return self._start, self._end
+        if not self.entry.when:
+            return None, None
+        return self.entry.when[0].start_time, self.entry.when[0].end_time
+
+
+class EventCache():
+    """Class representing a persistent on-disk store of calendar events.
+
+    Event entries are stored as atom xml strings keyed by event id. The
+    synced property is the feed updated timestamp of the last sync and is
+    used as the updated-min of the next sync. The index property is a
+    KeywordIndex of the what, description and where of the events. The
+    validators property holds the uri and validators of the first page of
+    the last sync, see Calendar.feed_entries(). The expansion property is
+    the (start, end) dates recurring events are expanded in, see
+    Calendar.sync().
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.index = KeywordIndex()
+        self.synced = None
+        self.validators = {}
+        self.expansion = None
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self.entries = {}
+        self.index = KeywordIndex()
+        self.synced = None
+        self.validators = {}
+        self.expansion = None
+
+    def load(self):
+        """Load the cache from file.
+        Returns:
+            True if the cache was loaded. False otherwise.
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return False
+        try:
+            with open(self.filename, 'rb') as f:
+                data = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError), err:
+            LOG.warn('Unable to read cache file {file}. {reason}'.format(
+                file=self.filename, reason=str(err)))
+            return False
+        if data.get('version') != CACHE_VERSION:
+            LOG.debug("Cache version mismatch, ignoring cache file.")
+            return False
+        self.entries = data['entries']
+        self.index = data['index']
+        self.synced = data['synced']
+        self.validators = data['validators']
+        self.expansion = data['expansion']
+        LOG.debug("Loaded {count} events from cache.".format(
+            count=len(self.entries)))
+        return True
+
+    def merge(self, entries):
+        """Merge event entries into the cache.
+        Args:
+            entries: list of CalendarEventEntry objects
+        Returns:
+            integer, number of entries merged
+
+        Notes:
+            Canceled (deleted) entries are removed from the cache. The
+            keyword index is updated for each entry merged.
+        """
+        count = 0
+        for entry in entries:
+            event_id = entry_id(entry)
+            if not event_id:
+                continue
+            count += 1
+            self.index.remove(event_id)
+            if entry.event_status and entry.event_status.value == 'CANCELED':
+                self.entries.pop(event_id, None)
+                continue
+            self.entries[event_id] = entry.ToString()
+            texts = []
+            if entry.title:
+                texts.append(entry.title.text)
+            if entry.content:
+                texts.append(entry.content.text)
+            if entry.where:
+                texts.append(entry.where[0].value_string)
+            self.index.add(event_id, texts)
+        return count
+
+    def save(self):
+        """Save the cache to file.
+
+        Notes:
+            The file is replaced in one step, so a reader never sees a
+            partially written cache, see gservice.atomic_write().
+        """
+        if not self.filename:
+            return
+        data = {
+                'version': CACHE_VERSION,
+                'synced': self.synced,
+                'entries': self.entries,
+                'index': self.index,
+                'validators': self.validators,
+                'expansion': self.expansion,
+                }
+        gservice.atomic_write(self.filename,
+            cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL), 'wb')
+
+
+class EventStore():
+    """Class representing a set of calendar events indexed by id.
+
+    Events are kept in the order they are added. Adding and removing events
+    is thread safe.
+    """
+    def __init__(self, events=None):
+        self.events = []
+        self.index = {}
+        self.lock = threading.Lock()
+        # Time index, see build_time_index()
+        self.by_when = None
+        self.starts = []
+        self.max_untils = []
+        self.untimed = []
+        for event in events or []:
+            self.add(event)
+
+    def __contains__(self, event_id):
+        return event_id in self.index
+
+    def __iter__(self):
+        return iter(list(self.events))
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event):
+        """Add an event to the store.
+        Args:
+            event: Event instance
+        Notes:
+            An event with the same id as an existing event replaces it.
+        """
+        with self.lock:
+            if event.id and event.id in self.index:
+                position = self.events.index(self.index[event.id])
+                self.events[position] = event
+            else:
+                self.events.append(event)
+            if event.id:
+                self.index[event.id] = event
+            self.by_when = None
+
+    def between(self, start=None, end=None):
+        """Return the events overlapping a time range.
+        Args:
+            start: string, 'yyyy-mm-dd hh:mm:ss', None for no lower limit
+            end: string, 'yyyy-mm-dd hh:mm:ss', None for no upper limit
+        Returns:
+            EventStore of events in order of start time.
+
+        Notes:
+            An event overlaps the range if it starts at or before the end and
+            ends at or after the start. Use the same value for start and end
+            to find the events in progress at a given time.
+
+            Events without a start time are only returned, last, if there
+            are no limits.
+        """
+        self.build_time_index()
+        high = len(self.starts)
+        if end is not None:
+            high = bisect.bisect_right(self.starts, end)
+        low = 0
+        if start is not None:
+            # Events before low all end before start.
+            low = bisect.bisect_left(self.max_untils, start)
+        events = []
+        for event in self.by_when[low:high]:
+            if start is None or (event.until or event.when) >= start:
+                events.append(event)
+        if start is None and end is None:
+            events.extend(self.untimed)
+        return EventStore(events)
+
+    def build_time_index(self):
+        """Build the time index of events if it is not current.
+
+        Notes:
+            by_when is the list of events with a start time, in order of
+            start time, and starts is the list of their start times. For each
+            position, max_untils is the latest end time of the events up to
+            and including that position. It never decreases so it can be
+            bisected to find the first event that may end after a given time.
+        """
+        with self.lock:
+            if self.by_when is not None:
+                return
+            by_when = [x for x in self.events if x.when]
+            by_when.sort(key=lambda x: x.when)
+            self.starts = [x.when for x in by_when]
+            self.max_untils = []
+            latest = ''
+            for event in by_when:
+                latest = max(latest, event.until or event.when)
+                self.max_untils.append(latest)
+            self.untimed = [x for x in self.events if not x.when]
+            self.by_when = by_when
+
+    def get(self, event_id):
+        """Get an event by id.
+        Args:
+            event_id: string, event id
+        Returns:
+            Event instance, if found. None, otherwise.
+        """
+        return self.index.get(event_id)
+
+    def remove(self, event_id):
+        """Remove an event from the store.
+        Args:
+            event_id: string, event id
+        """
+        with self.lock:
+            event = self.index.pop(event_id, None)
+            if event:
+                self.events.remove(event)
+                self.by_when = None
+
+
+class EventTimes():
+    """This class converts the start and end times of many events at once.
+
+    The timestamps are parsed into numpy datetime64 arrays so converting to
+    local time, formatting, range filtering and ordering are array
+    operations. Timestamps of the shapes used by google are parsed in bulk,
+    anything else is converted with TIMESTAMPS one at a time. The results
+    are the same as TimestampConverter.convert().
+
+    Requires numpy.
+    """
+    # Timestamp length to index of the timezone designator, None if none.
+    shapes = {10: None, 20: 19, 24: 23, 25: 19, 29: 23}
+
+    def __init__(self, starts, ends):
+        self.starts = self.local(starts)  # datetime64 arrays, NaT if empty
+        self.ends = self.local(ends)
+
+    def between(self, start=None, end=None):
+        """Return the indices of events within a time range.
+        Args:
+            start: string, yyyy-mm-dd hh:mm:ss, None for no lower bound
+            end: string, yyyy-mm-dd hh:mm:ss, None for no upper bound
+        Returns:
+            numpy array of indices ordered by start time, events without
+            a start time last if there are no limits. See
+            EventStore.between() for the semantics.
+        """
+        timed = ~numpy.isnat(self.starts)
+        keep = timed.copy()
+        if start:
+            start = numpy.datetime64(start.replace(' ', 'T'), 's')
+            untils = numpy.where(numpy.isnat(self.ends), self.starts,
+                self.ends)
+            keep &= untils >= start
+        if end:
+            keep &= self.starts <= numpy.datetime64(end.replace(' ', 'T'),
+                's')
+        indices = numpy.flatnonzero(keep)
+        order = numpy.argsort(self.starts[indices], kind='mergesort')
+        if start or end:
+            return indices[order]
+        return numpy.concatenate((indices[order], numpy.flatnonzero(~timed)))
+
+    def local(self, timestamps):
+        """Convert timestamps to local time.
+        Args:
+            timestamps: list of strings, ISO-8601 timestamps or None
+        Returns:
+            numpy datetime64[s] array, NaT where a timestamp is empty
+        """
+        count = len(timestamps)
+        utc = numpy.zeros(count, dtype='int64')
+        present = numpy.zeros(count, dtype=bool)
+        if not count:
+            return utc.astype('datetime64[s]')
+        texts = numpy.array([x or '' for x in timestamps], dtype=str)
+        if texts.dtype.itemsize < 10:
+            texts = texts.astype('S10')
+        chars = texts.view('uint8').reshape(count, texts.dtype.itemsize)
+        lengths = numpy.char.str_len(texts)
+        parsed = numpy.zeros(count, dtype=bool)
+        for length, tzd in self.shapes.items():
+            rows = numpy.flatnonzero(lengths == length)
+            if not len(rows):
+                continue
+            rows = rows[self.well_formed(chars[rows], length, tzd)]
+            if not len(rows):
+                continue
+            try:
+                naive = texts[rows].astype('S19').astype('datetime64[s]')
+            except ValueError:
+                continue
+            utc[rows] = naive.astype('int64')
+            if tzd is not None and length - tzd > 1:
+                utc[rows] -= self.tzd_offsets(chars[rows], tzd)
+            parsed[rows] = True
+        present[parsed] = True
+        for row in numpy.flatnonzero(~parsed & (lengths > 0)):
+            utc[row] = TIMESTAMPS.seconds(timestamps[row])
+            present[row] = True
+        local = utc + self.utc_offsets(utc)
+        local = local.astype('datetime64[s]')
+        local[~present] = numpy.datetime64('NaT')
+        return local
+
+    def strings(self, times):
+        """Format local times.
+        Args:
+            times: numpy datetime64[s] array
+        Returns:
+            list of strings, yyyy-mm-dd hh:mm:ss, None where NaT
+        """
+        if not len(times):
+            return []
+        texts = numpy.datetime_as_string(times, unit='s').astype('S19')
+        texts.view('S1').reshape(len(texts), 19)[:, 10] = ' '
+        texts = texts.tolist()
+        for row in numpy.flatnonzero(numpy.isnat(times)):
+            texts[row] = None
+        return texts
+
+    def tzd_offsets(self, chars, tzd):
+        """Return the UTC offsets of timezone designators.
+        Args:
+            chars: numpy uint8 array, one row per timestamp
+            tzd: integer, index of the designator in each row
+        Returns:
+            numpy int64 array, seconds
+        """
+        digits = chars.astype('int64') - ord('0')
+        offsets = ((digits[:, tzd + 1] * 10 + digits[:, tzd + 2]) * 60 +
+            digits[:, tzd + 4] * 10 + digits[:, tzd + 5]) * 60
+        offsets[chars[:, tzd] == ord('-')] *= -1
+        return offsets
+
+    def utc_offsets(self, utc):
+        """Return the local UTC offsets at times.
+
+        Offsets are looked up at the start and end of each day. Only times
+        on days where the two differ are looked up individually.
+
+        Args:
+            utc: numpy int64 array, seconds since the epoch
+        Returns:
+            numpy int64 array, seconds to add to UTC to get local time
+        """
+        days, inverse = numpy.unique(utc // 86400, return_inverse=True)
+        firsts = numpy.array([TIMESTAMPS.utc_offset(x * 86400)
+            for x in days.tolist()], dtype='int64')
+        lasts = numpy.array([TIMESTAMPS.utc_offset(x * 86400 + 86400 - 900)
+            for x in days.tolist()], dtype='int64')
+        offsets = firsts[inverse]
+        for row in numpy.flatnonzero((firsts != lasts)[inverse]):
+            offsets[row] = TIMESTAMPS.utc_offset(int(utc[row]))
+        return offsets
+
+    def well_formed(self, chars, length, tzd):
+        """Return which timestamps have the expected punctuation.
+        Args:
+            chars: numpy uint8 array, one row per timestamp of the length
+            length: integer, length of the timestamps
+            tzd: integer, index of the timezone designator, None if none
+        Returns:
+            numpy boolean array
+        """
+        punctuation = {4: '-', 7: '-'}
+        if length > 10:
+            punctuation.update({10: 'T', 13: ':', 16: ':'})
+        if tzd is not None and tzd > 19:
+            punctuation[19] = '.'
+        if tzd is not None and length - tzd == 6:
+            punctuation[tzd + 3] = ':'
+        ok = numpy.ones(len(chars), dtype=bool)
+        for index, char in punctuation.items():
+            ok &= chars[:, index] == ord(char)
+        digit_columns = [x for x in range(length)
+            if x not in punctuation and x != tzd]
+        digits = chars[:, digit_columns]
+        ok &= ((digits >= ord('0')) & (digits <= ord('9'))).all(axis=1)
+        if tzd is not None:
+            signs = (ord('Z'),) if length - tzd == 1 else (ord('+'), ord('-'))
+            ok &= numpy.in1d(chars[:, tzd], signs)
+        return ok
 
 
 class Iso8601():
@@ -696,29 +2097,500 @@ class Iso8601():
             return -offset
         return offset
 
-    def __find_julian(self, year, julian):
-        """Find julian date."""
-        # R0201: *Method could be a function*
-        # pylint: disable=R0201
-        month = julian / 30 + 1
-        day = julian % 30 + 1
-        jday = None
-        while jday != julian:
-            t = time.mktime((year, month, day, 0, 0, 0, 0, 0, 0))
-            jday = time.gmtime(t)[-2]
-            diff = abs(jday - julian)
-            if jday > julian:
-                if diff < day:
-                    day = day - diff
-                else:
-                    month = month - 1
-                    day = 31
-            elif jday < julian:
-                if day + diff < 28:
-                    day = day + diff
-                else:
-                    month = month + 1
-        return year, month, day
+    def __find_julian(self, year, julian):
+        """Find julian date."""
+        # R0201: *Method could be a function*
+        # pylint: disable=R0201
+        date = datetime.date(year, 1, 1) + datetime.timedelta(days=julian - 1)
+        return date.year, date.month, date.day
+
+
+class KeywordIndex():
+    """Class representing an inverted index of the words in events.
+
+    The postings property maps each word to the set of ids of the events
+    containing it. Words are lower case.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.words = {}          # Event id to its words
+        self.vocabulary = None   # Sorted list of words, see search()
+
+    def add(self, key, texts):
+        """Add the words of texts to the index.
+        Args:
+            key: string, event id
+            texts: list of strings, None values are ignored
+        """
+        words = set(tokenize(texts))
+        self.words[key] = words
+        for word in words:
+            if word not in self.postings:
+                self.postings[word] = set()
+                self.vocabulary = None
+            self.postings[word].add(key)
+
+    def remove(self, key):
+        """Remove an event from the index.
+        Args:
+            key: string, event id
+        """
+        for word in self.words.pop(key, []):
+            self.postings[word].discard(key)
+            if not self.postings[word]:
+                del self.postings[word]
+                self.vocabulary = None
+
+    def search(self, keyword, prefix=False):
+        """Find the events matching every word of a keyword.
+        Args:
+            keyword: string, one or more words
+            prefix: If True, keyword words match the start of event words.
+        Returns:
+            set of event ids
+        """
+        result = None
+        for keyword_word in tokenize([keyword]):
+            if prefix:
+                if self.vocabulary is None:
+                    self.vocabulary = sorted(self.postings)
+                keys = set()
+                start = bisect.bisect_left(self.vocabulary, keyword_word)
+                for word in self.vocabulary[start:]:
+                    if not word.startswith(keyword_word):
+                        break
+                    keys.update(self.postings[word])
+            else:
+                keys = self.postings.get(keyword_word, set())
+            if result is None:
+                result = set(keys)
+            else:
+                result.intersection_update(keys)
+            if not result:
+                break
+        return result or set()
+
+
+class Query():
+    """Class representing a compiled event search query.
+
+    Query syntax:
+
+        word            events with a word starting with, or equal to, word
+        "some phrase"   events containing the phrase
+        field:term      the term is matched against one field only, one of
+                        what, where, desc, or remind
+        a b, a AND b    events matching both a and b
+        a OR b          events matching either a or b
+        NOT a, -a       events not matching a
+        ( ... )         grouping
+
+    AND binds more tightly than OR. Terms without a field are matched
+    against the what, description and where. Operators must be upper case.
+
+    The query is parsed into a tree of nodes, lists of the form:
+        ['and', [nodes]], ['or', [nodes]], ['not', node],
+        ['term', (event attributes), text, is_phrase]
+    """
+    FIELDS = {
+        'desc': ('description',),
+        'remind': ('reminders',),
+        'what': ('what',),
+        'where': ('where',),
+        }
+    DEFAULT_FIELDS = ('what', 'description', 'where')
+
+    def __init__(self, text, match='prefix'):
+        """Constructor
+        Args:
+            text: string, query
+            match: string, word matching mode, one of 'prefix', 'word'
+        Raises:
+            ValueError, if the query text is invalid.
+        """
+        self.match = match
+        self.tokens = self.lex(text)
+        self.position = 0
+        self.root = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError("Unexpected ')' in query.")
+        self.order(self.root)
+
+    def candidates(self, index, node=None):
+        """Find the events that may match the query using an index.
+        Args:
+            index: KeywordIndex instance
+            node: list, query node, defaults to the root node
+        Returns:
+            set of event ids, a superset of the events matching the query.
+            None, if the index can't narrow the events.
+
+        Notes:
+            The children of 'and' nodes are reordered so the most selective
+            are evaluated first by is_match().
+        """
+        if node is None:
+            node = self.root
+        kind = node[0]
+        if kind == 'term':
+            unused_kind, fields, text, is_phrase = node
+            if is_phrase or 'reminders' in fields:
+                return None
+            return index.search(text, prefix=(self.match == 'prefix'))
+        if kind == 'not':
+            return None
+        children = node[1]
+        sets = [self.candidates(index, x) for x in children]
+        if kind == 'or':
+            if None in sets:
+                return None
+            result = set()
+            for keys in sets:
+                result.update(keys)
+            return result
+        sizes = {}
+        for child, keys in zip(children, sets):
+            if keys is None:
+                sizes[id(child)] = len(index.words)
+            else:
+                sizes[id(child)] = len(keys)
+        children.sort(key=lambda x: (sizes[id(x)], self.cost(x)))
+        known = [x for x in sets if x is not None]
+        if not known:
+            return None
+        known.sort(key=len)
+        result = set(known[0])
+        for keys in known[1:]:
+            result.intersection_update(keys)
+        return result
+
+    def cost(self, node):
+        """Estimate the relative cost of matching a node against an event.
+        Args:
+            node: list, query node
+        Returns:
+            integer
+        """
+        kind = node[0]
+        if kind == 'term':
+            if node[3]:
+                return 2 * len(node[1])
+            return len(node[1])
+        if kind == 'not':
+            return self.cost(node[1])
+        return sum([self.cost(x) for x in node[1]])
+
+    def is_match(self, event, node=None):
+        """Determine if an event matches the query.
+        Args:
+            event: Event instance
+            node: list, query node, defaults to the root node
+        Returns:
+            True if event is a match.
+        """
+        if node is None:
+            node = self.root
+        kind = node[0]
+        if kind == 'and':
+            for child in node[1]:
+                if not self.is_match(event, child):
+                    return False
+            return True
+        if kind == 'or':
+            for child in node[1]:
+                if self.is_match(event, child):
+                    return True
+            return False
+        if kind == 'not':
+            return not self.is_match(event, node[1])
+
+        unused_kind, fields, text, is_phrase = node
+        for field in fields:
+            value = getattr(event, field)
+            if field == 'reminders':
+                value = ' '.join(value)
+            if not value:
+                continue
+            if is_phrase:
+                if text in value.lower():
+                    return True
+                continue
+            for word in tokenize([value]):
+                if word == text:
+                    return True
+                if self.match == 'prefix' and word.startswith(text):
+                    return True
+        return False
+
+    def lex(self, text):
+        """Split query text into tokens.
+        Args:
+            text: string, query
+        Returns:
+            list of tokens, tuples, one of ('(',), (')',), ('AND',), ('OR',),
+            ('NOT',), or ('term', fields, text, is_phrase)
+        """
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            mo = P_QUERY_TOKEN.match(text, position)
+            if not mo:
+                raise ValueError("Invalid query at: {txt}".format(
+                    txt=text[position:]))
+            position = mo.end()
+            if mo.group('paren'):
+                tokens.append((mo.group('paren'),))
+                continue
+            field = mo.group('field')
+            word = mo.group('word')
+            if not field and not mo.group('neg') and \
+                    word in ('AND', 'OR', 'NOT'):
+                tokens.append((word,))
+                continue
+            fields = self.DEFAULT_FIELDS
+            if field:
+                if field not in self.FIELDS:
+                    raise ValueError("Unknown query field: {fld}".format(
+                        fld=field))
+                fields = self.FIELDS[field]
+            if mo.group('neg'):
+                tokens.append(('NOT',))
+            if mo.group('phrase') is not None:
+                tokens.append(('term', fields, mo.group('phrase').lower(),
+                    True))
+                continue
+            if not P_WORD_ONLY.match(word):
+                raise ValueError("Invalid query word: {wrd}".format(wrd=word))
+            tokens.append(('term', fields, word.lower(), False))
+        return tokens
+
+    def order(self, node):
+        """Order the children of nodes so the cheapest are evaluated first.
+        Args:
+            node: list, query node
+        """
+        kind = node[0]
+        if kind == 'not':
+            self.order(node[1])
+        elif kind in ('and', 'or'):
+            for child in node[1]:
+                self.order(child)
+            node[1].sort(key=self.cost)
+
+    def parse_and(self):
+        """Parse a conjunction of terms."""
+        children = [self.parse_not()]
+        while self.peek() not in (None, 'OR', ')'):
+            if self.peek() == 'AND':
+                self.position += 1
+            children.append(self.parse_not())
+        if len(children) == 1:
+            return children[0]
+        return ['and', children]
+
+    def parse_not(self):
+        """Parse a term, a negated term or a parenthesized query."""
+        kind = self.peek()
+        if kind is None:
+            raise ValueError("Unexpected end of query.")
+        token = self.tokens[self.position]
+        self.position += 1
+        if kind == 'NOT':
+            return ['not', self.parse_not()]
+        if kind == '(':
+            node = self.parse_or()
+            if self.peek() != ')':
+                raise ValueError("Missing ')' in query.")
+            self.position += 1
+            return node
+        if kind == 'term':
+            return list(token)
+        raise ValueError("Unexpected {tok} in query.".format(tok=kind))
+
+    def parse_or(self):
+        """Parse a disjunction of conjunctions."""
+        children = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.position += 1
+            children.append(self.parse_and())
+        if len(children) == 1:
+            return children[0]
+        return ['or', children]
+
+    def peek(self):
+        """Return the kind of the next token, None if there are none."""
+        if self.position >= len(self.tokens):
+            return None
+        return self.tokens[self.position][0]
+
+    def text_query(self, node=None):
+        """Return a google full text query matching a superset of the
+        events the query matches.
+        Args:
+            node: list, query node, defaults to the root node
+        Returns:
+            string, words separated by spaces. None, if the query has no
+            words every matching event must contain.
+
+        Notes:
+            Only whole words can be pushed down, so prefix matched words,
+            phrases, reminders, 'not' and 'or' nodes are left out. The
+            children of an 'and' node are all required so any of their
+            words can be sent.
+        """
+        if node is None:
+            node = self.root
+        kind = node[0]
+        if kind == 'term':
+            unused_kind, fields, text, is_phrase = node
+            if is_phrase or 'reminders' in fields or self.match != 'word':
+                return None
+            return text
+        if kind != 'and':
+            return None
+        words = [self.text_query(x) for x in node[1]]
+        return ' '.join([x for x in words if x]) or None
+
+
+class TimestampConverter():
+    """This class converts ISO-8601 timestamps to local time strings.
+
+    Timestamps of the shapes used by google, 'yyyy-mm-ddThh:mm:ss.sss+hh:mm'
+    or 'yyyy-mm-dd', are split into date, time and timezone designator
+    parts. Each part is converted to seconds once and cached, so converting
+    a timestamp is mostly dictionary lookups. Anything else is parsed with
+    Iso8601. The results are the same as Iso8601.parse() formatted with
+    time.localtime().
+
+    The local UTC offset is looked up once per 15 minute interval, the
+    granularity of timezone offsets, and cached.
+    """
+    # Number of items cached before a cache is cleared.
+    max_cached = 100000
+    # Days from 0001-01-01 to 1970-01-01
+    epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+    def __init__(self):
+        self.dates = {}          # 'yyyy-mm-dd' to seconds since the epoch
+        self.times = {}          # 'hh:mm:ss' to seconds since midnight
+        self.tzds = {'Z': 0, None: 0}   # Designator to seconds from UTC
+        self.offsets = {}        # Interval start, seconds, to UTC offset
+        self.local_dates = {}    # Days since the epoch to 'yyyy-mm-dd'
+        self.local_times = {}    # Seconds since midnight to 'hh:mm:ss'
+
+    def convert(self, timestamp):
+        """Convert a timestamp to a local time string.
+        Args:
+            timestamp: string, eg '2010-01-03T10:00:00.000-05:00'
+        Returns:
+            string, eg '2010-01-03 10:00:00'. None if timestamp is empty.
+        """
+        if not timestamp:
+            return None
+        seconds = self.seconds(timestamp)
+        seconds = int(seconds + self.utc_offset(seconds))
+        days, seconds = divmod(seconds, 86400)
+        try:
+            date = self.local_dates[days]
+        except KeyError:
+            date = datetime.date.fromordinal(
+                days + self.epoch_ordinal).strftime('%Y-%m-%d')
+            self.local_dates[days] = date
+        try:
+            clock = self.local_times[seconds]
+        except KeyError:
+            clock = '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                seconds % 60)
+            self.local_times[seconds] = clock
+        return date + ' ' + clock
+
+    def convert_all(self, timestamps):
+        """Convert a list of timestamps to local time strings.
+        Args:
+            timestamps: list of strings
+        Returns:
+            list of strings, see convert()
+        """
+        convert = self.convert
+        return [convert(x) for x in timestamps]
+
+    def seconds(self, timestamp):
+        """Return a timestamp as seconds since the epoch.
+        Args:
+            timestamp: string, ISO-8601 timestamp
+        Returns:
+            integer
+        """
+        # C0103: *Invalid name "%s" (should match %s)*
+        # pylint: disable=C0103
+        m = P_TIMESTAMP.match(timestamp)
+        if not m:
+            return Iso8601(timestamp=timestamp).parse()
+        date, clock, tzd = m.groups()
+        try:
+            seconds = self.dates[date]
+        except KeyError:
+            if len(self.dates) >= self.max_cached:
+                self.dates = {}
+            seconds = (datetime.date(int(date[0:4]), int(date[5:7]),
+                int(date[8:10])).toordinal() - self.epoch_ordinal) * 86400
+            self.dates[date] = seconds
+        if clock:
+            try:
+                seconds += self.times[clock]
+            except KeyError:
+                self.times[clock] = (int(clock[0:2]) * 60 +
+                    int(clock[3:5])) * 60 + int(clock[6:8])
+                seconds += self.times[clock]
+        try:
+            return seconds - self.tzds[tzd]
+        except KeyError:
+            offset = (int(tzd[1:3]) * 60 + int(tzd[4:6])) * 60
+            if tzd[0] == '-':
+                offset = -offset
+            self.tzds[tzd] = offset
+            return seconds - offset
+
+    def utc_offset(self, seconds):
+        """Return the local UTC offset at a time.
+        Args:
+            seconds: integer, seconds since the epoch
+        Returns:
+            integer, seconds to add to UTC to get local time
+        """
+        interval = int(seconds) - int(seconds) % 900
+        try:
+            return self.offsets[interval]
+        except KeyError:
+            pass
+        if len(self.offsets) >= self.max_cached:
+            self.offsets = {}
+        local = time.localtime(interval)
+        offset = (datetime.date(local[0], local[1], local[2]).toordinal() -
+            self.epoch_ordinal) * 86400 + (local[3] * 60 + local[4]) * 60 + \
+            local[5] - interval
+        self.offsets[interval] = offset
+        return offset
+
+
+TIMESTAMPS = TimestampConverter()
+
+
+def cache_filename(email, calendar_id='default'):
+    """Return the name of the event cache file of a calendar.
+    Args:
+        email: string, email address of the account
+        calendar_id: string, calendar id
+    Returns:
+        string, file name
+    """
+    # The default calendar keeps the cache file name it always had.
+    name = email
+    if calendar_id != 'default':
+        name = '{email}.{cal}'.format(email=email,
+            cal=urllib.quote(calendar_id, safe='@'))
+    return os.path.join(CACHE_DIR, '{name}.events'.format(name=name))
 
 
 def check_date(unused_option, opt, value):
@@ -739,6 +2611,333 @@ def check_date(unused_option, opt, value):
     return value
 
 
+def daemon_query(args, out=None, socket_path=DAEMON_SOCKET):
+    """Run a query with the daemon, see Daemon.
+    Args:
+        args: list of strings, command line arguments of the query
+        out: file object the daemon output is written to, default sys.stdout
+        socket_path: string, name of the daemon socket file
+    Returns:
+        True if the daemon ran the query. False if no daemon is running or
+        the daemon declined the query. The query should then be run
+        directly.
+    """
+    if out is None:
+        out = sys.stdout
+    if not os.path.exists(socket_path):
+        return False
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(socket_path)
+            connection.sendall(json.dumps(args) + '\n')
+            # Unbuffered so no output is read past the status line.
+            reader = connection.makefile('rb', 0)
+            status = reader.readline().strip()
+        except socket.error, err:
+            LOG.debug("Daemon not available. {reason}".format(
+                reason=str(err)))
+            return False
+        if status != 'ok':
+            LOG.debug("Daemon declined query.")
+            return False
+        LOG.debug("Query run by daemon.")
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            out.write(data)
+        out.flush()
+    finally:
+        connection.close()
+    return True
+
+
+def daemon_running(socket_path=DAEMON_SOCKET):
+    """Return True if a daemon is serving queries on the socket.
+    Args:
+        socket_path: string, name of the daemon socket file
+    Returns:
+        boolean
+    """
+    if not os.path.exists(socket_path):
+        return False
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+def entry_etag(entry):
+    """Return the etag of a calendar event entry.
+    Args:
+        entry: CalendarEventEntry instance
+    Returns:
+        string, the gd:etag attribute of the entry, None if it has none.
+    """
+    return entry.extension_attributes.get(GD_NS + 'etag')
+
+
+def entry_id(entry):
+    """Return the event id of a calendar event entry.
+    Args:
+        entry: CalendarEventEntry instance
+    Returns:
+        string, event id, eg 'h1vqotvj45rmkaf86rr7cru8cc'. None if the entry
+        has no id.
+    """
+    if not entry.id:
+        return None
+    match = P_ID.match(entry.id.text)
+    if not match:
+        return None
+    return match.group(1)
+
+
+def entry_record(elem):
+    """Return the record of a calendar event entry element.
+    Args:
+        elem: ElementTree element, an Atom entry
+    Returns:
+        dictionary, see parse_entries()
+    """
+    record = {'id': None, 'what': None, 'description': None,
+        'where': None, 'reminders': [], 'start': None, 'end': None}
+    match = P_ID.match(elem.findtext(ATOM_NS + 'id') or '')
+    if match:
+        record['id'] = match.group(1)
+    title = elem.find(ATOM_NS + 'title')
+    if title is not None:
+        record['what'] = member_string(title.text)
+    content = elem.find(ATOM_NS + 'content')
+    if content is not None:
+        record['description'] = member_string(content.text)
+    when = elem.find(GD_NS + 'when')
+    if when is not None:
+        record['start'] = member_string(when.get('startTime'))
+        record['end'] = member_string(when.get('endTime'))
+        for reminder in when.findall(GD_NS + 'reminder'):
+            record['reminders'].append('{min} minutes by {method}'.format(
+                min=member_string(reminder.get('minutes')),
+                method=member_string(reminder.get('method'))))
+    where = elem.find(GD_NS + 'where')
+    if where is not None:
+        record['where'] = member_string(where.get('valueString'))
+    return record
+
+
+def event_action(attributes):
+    """Determine the action to take for a set of event attributes.
+    Args:
+        attributes: dictionary, see Calendar.event_attributes()
+    Returns:
+        string, one of 'add', 'delete', or 'update'
+    """
+    if 'id' in attributes:
+        if 'what' in attributes and attributes['what'] == 'DELETE':
+            return 'delete'
+        return 'update'
+    return 'add'
+
+
+def event_sort_key(event, sort_by):
+    """Return the key to sort an event by.
+    Args:
+        event: Event instance
+        sort_by: string, attribute to sort events by
+    Returns:
+        string
+    """
+    # The tilde char sorts after alpha numeric characters. By defaulting the
+    # sort key to start with tilde, any events without a value in the sort_by
+    # field will sort to the end of the list. The event.id is appended to the
+    # sort key so events without a value are always in the same order.
+    value = getattr(event, sort_by)
+    if not value:
+        return ''.join(('~n/a~', event.id or ''))
+    return str(value).lower()
+
+
+def fetch_calendars(calendars, keyword=None, match_id=None,
+        match='regex', workers=FETCH_WORKERS):
+    """Generator of the events of several calendars in order of start time.
+    Args:
+        calendars: list of Calendar instances, query filters set
+        keyword, match_id, match: see Calendar.filter()
+        workers: integer, number of calendars fetched at once
+    Returns:
+        Generator of Event instances, the calendar property is set to the
+        calendar id.
+
+    Notes:
+        Each calendar is fetched and filtered in a thread, at most workers
+        at a time, so the time taken is about that of the slowest calendar.
+        The threads pass events through queues to a merge on start time.
+        Events without a start time are last. An exception raised fetching
+        a calendar is raised by the generator.
+    """
+    semaphore = threading.Semaphore(workers)
+
+    def produce(calendar, queue):
+        """Put the events of a calendar on a queue."""
+        try:
+            with semaphore:
+                for event in calendar.filter(calendar.get(),
+                        keyword=keyword, match_id=match_id, match=match):
+                    event.calendar = calendar.calendar_id
+                    queue.put((None, event))
+        # W0703: *Catch "Exception"*
+        # pylint: disable=W0703
+        except Exception:
+            queue.put((sys.exc_info(), None))
+            return
+        queue.put((None, None))
+
+    def consume(index, queue):
+        """Generator of the sort keys and events of a queue."""
+        sequence = itertools.count()
+        while True:
+            error, event = queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if event is None:
+                return
+            yield (event.when is None, event.when, index, sequence.next(),
+                event)
+
+    streams = []
+    for index, calendar in enumerate(calendars):
+        queue = Queue.Queue()
+        thread = threading.Thread(target=produce, args=(calendar, queue))
+        thread.daemon = True
+        thread.start()
+        streams.append(consume(index, queue))
+    for item in heapq.merge(*streams):
+        yield item[-1]
+
+
+def format_csv(event):
+    """Format an event as a CSV row.
+    Args:
+        event: Event instance
+    Returns:
+        string, a row of the fields of PRINT_HEADERS['csv']
+    """
+    row = StringIO()
+    csv.writer(row, lineterminator='\n').writerow([utf8(x) for x in (
+        event.id, event.what, event.when, event.until, event.where,
+        event.description, '; '.join(event.reminders), event.calendar)])
+    return row.getvalue()
+
+
+def format_ics(event):
+    """Format an event as an RFC 5545 iCalendar VEVENT component.
+    Args:
+        event: Event instance
+    Returns:
+        string, lines end with CRLF
+
+    Notes:
+        Times are local times without a timezone, "floating" times in
+        iCalendar terms. Events without a start time, eg recurring
+        events, are not valid VEVENTs without a start time and are
+        skipped. Reminders are DISPLAY alarms.
+    """
+    if not event.when:
+        return ''
+    ics_time = lambda x: x.replace('-', '').replace(':', '').replace(' ', 'T')
+    lines = ['BEGIN:VEVENT',
+        'UID:{id}@google.com'.format(id=event.id),
+        'DTSTAMP:{now}'.format(now=time.strftime('%Y%m%dT%H%M%SZ',
+            time.gmtime())),
+        'DTSTART:{when}'.format(when=ics_time(event.when))]
+    if event.until:
+        lines.append('DTEND:{until}'.format(until=ics_time(event.until)))
+    for name, value in (('SUMMARY', event.what), ('LOCATION', event.where),
+            ('DESCRIPTION', event.description),
+            ('CATEGORIES', event.calendar)):
+        if value:
+            lines.append('{name}:{text}'.format(name=name,
+                text=ics_text(value)))
+    for reminder in event.reminders:
+        match = P_REMINDER.match(reminder)
+        if not match or not match.group(1).isdigit():
+            continue
+        lines.extend(['BEGIN:VALARM', 'ACTION:DISPLAY',
+            'TRIGGER:-PT{min}M'.format(min=match.group(1)),
+            'DESCRIPTION:{text}'.format(text=ics_text(event.what or
+                'Reminder')),
+            'END:VALARM'])
+    lines.append('END:VEVENT')
+    return ''.join([ics_fold(x) for x in lines])
+
+
+def format_jsonl(event):
+    """Format an event as a line of JSON.
+    Args:
+        event: Event instance
+    Returns:
+        string, a JSON object and a newline
+    """
+    return json.dumps({'id': event.id, 'what': event.what,
+        'when': event.when, 'until': event.until, 'where': event.where,
+        'description': event.description, 'reminders': event.reminders,
+        'calendar': event.calendar}, sort_keys=True) + '\n'
+
+
+def format_long(event):
+    """Format an event, one line per attribute. See Calendar.print_events().
+    Args:
+        event: Event instance
+    Returns:
+        string
+    """
+    lines = ['\n']
+    for field in ('calendar', 'id', 'what', 'when', 'until', 'where',
+            'description'):
+        value = getattr(event, field)
+        if value:
+            lines.append('{field}: {prt}\n'.format(field=field, prt=value))
+    for reminder in event.reminders:
+        lines.append('remind: {rem}\n'.format(rem=reminder))
+    return ''.join(lines)
+
+
+def format_short(event):
+    """Format an event on one line. See Calendar.print_events().
+    Args:
+        event: Event instance
+    Returns:
+        string
+    """
+    if event.calendar:
+        return '{when}\t{what}\t{cal}\n'.format(when=event.when,
+            what=event.what, cal=event.calendar)
+    return '{when}\t{what}\n'.format(when=event.when, what=event.what)
+
+
+# Print mode to function formatting an event, see Calendar.print_events().
+PRINT_MODES = {
+        'csv': format_csv,
+        'ics': format_ics,
+        'jsonl': format_jsonl,
+        'long': format_long,
+        'short': format_short,
+        }
+PRINT_HEADERS = {
+        'csv': 'id,what,when,until,where,description,reminders,calendar\n',
+        'ics': 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\n'
+            'PRODID:-//gcalendar.py//EN\r\n',
+        }
+PRINT_FOOTERS = {
+        'ics': 'END:VCALENDAR\r\n',
+        }
+
+
 def get_email_address():
     """ Get the google email address associated with Google calendar.
     Args:
@@ -796,6 +2995,347 @@ def get_password(email_address):
     return getpass.getpass()
 
 
+def ics_fold(line):
+    """Fold an iCalendar content line to lines of at most 75 octets.
+    Args:
+        line: string, utf-8 encoded
+    Returns:
+        string, the folded line ending with CRLF
+    """
+    folded = []
+    width = 75
+    while len(line) > width:
+        cut = width
+        # Don't split a multi-octet utf-8 character.
+        while cut > 1 and 0x80 <= ord(line[cut]) < 0xC0:
+            cut -= 1
+        folded.append(line[:cut])
+        line = ' ' + line[cut:]
+    folded.append(line)
+    return '\r\n'.join(folded) + '\r\n'
+
+
+def ics_text(text):
+    """Escape an iCalendar TEXT value.
+    Args:
+        text: string
+    Returns:
+        string, utf-8 encoded
+    """
+    text = utf8(text).replace('\\', '\\\\').replace(';', '\\;')
+    return text.replace(',', '\\,').replace('\r\n', '\\n').replace(
+        '\n', '\\n')
+
+
+def import_modules(offline=False):
+    """Import the modules deferred at start up and define the classes
+    derived from gdata and atom classes, eg CalendarService.
+    Args:
+        offline: If True, only import the modules needed to read the event
+            cache, see --offline.
+
+    Notes:
+        Call before talking to google calendar or reading the cache. The
+        paths that do not, --help and queries run by the daemon, start
+        without importing gdata, as do --offline queries. See
+        tests/test_gcalendar.py for a check.
+    """
+    # W0603: *Using the global statement*
+    # W0621: *Redefining name %r from outer scope*
+    # pylint: disable=W0603,W0621
+    global atom, ElementTree, gdata, numpy, shutil, subprocess, tempfile, \
+        urllib, CalendarService
+    if CalendarService is not None:
+        return
+    import urllib
+    import xml.etree.cElementTree as ElementTree
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if offline:
+        return
+    import atom
+    import atom.service
+    import gdata.calendar
+    import gdata.calendar.service
+    import gdata.service
+    import shutil
+    import subprocess
+    import tempfile
+    gservice.import_modules()
+
+    class CalendarService(gservice.GovernedServiceMixin,
+            gdata.calendar.service.CalendarService):
+        """Class representing a Google calendar service client, see
+        gservice.GovernedServiceMixin.
+
+        Requests may be sent from several threads at once, eg feed pages,
+        calendars and event updates.
+        """
+        def lookup_password(self):
+            """Return the password of the account, see get_password()."""
+            return get_password(self.email)
+
+
+def list_calendars(gd_client):
+    """Return the calendars of the account.
+    Args:
+        gd_client: CalendarService instance
+    Returns:
+        list of tuples, (calendar id, title)
+    """
+    calendars = []
+    for entry in gd_client.GetAllCalendarsFeed().entry:
+        calendar_id = urllib.unquote(entry.id.text.rstrip('/').split('/')[-1])
+        calendars.append((calendar_id, entry.title.text))
+    return calendars
+
+
+def log_action(action, attributes):
+    """Log the action taken on an event.
+    Args:
+        action: string, one of 'add', 'delete', or 'update'
+        attributes: dictionary, see Calendar.event_attributes()
+    """
+    label = ''
+    if 'what' in attributes:
+        label = attributes['what']
+    elif 'description' in attributes:
+        label = attributes['description']
+    else:
+        label = attributes['id']
+    action_labels = {
+        'add': 'Adding',
+        'delete': 'Deleting',
+        'update': 'Updating',
+        }
+    LOG.info("{action}: {label}".format(action=action_labels[action],
+            label=label))
+
+
+def map_ahead(func, items, workers=1):
+    """Generator of the results of calling a function for each item, with
+    up to workers calls in progress ahead of the one yielded.
+    Args:
+        func: function accepting a single item
+        items: iterable of items, may be endless
+        workers: integer, maximum number of calls in progress
+    Returns:
+        Generator of results in the order of items.
+
+    Notes:
+        An exception raised by a call is raised by the generator. Items are
+        taken from items only as calls are started, so the generator can be
+        closed once the results needed are yielded. Calls in progress then
+        finish in the background and their results are discarded.
+    """
+    items = iter(items)
+    pending = []
+
+    def start(item):
+        """Start a call in a thread, return the queue of its result."""
+        result = Queue.Queue(1)
+
+        def call():
+            """Call func and put the result, or exception, on the queue."""
+            try:
+                result.put((func(item), None))
+            # W0703: *Catch "Exception"*
+            # pylint: disable=W0703
+            except Exception:
+                result.put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=call)
+        thread.daemon = True
+        thread.start()
+        return result
+
+    for item in itertools.islice(items, max(workers, 1)):
+        pending.append(start(item))
+    while pending:
+        value, error = pending.pop(0).get()
+        if error:
+            raise error[0], error[1], error[2]
+        for item in itertools.islice(items, 1):
+            pending.append(start(item))
+        yield value
+
+
+def member_string(text):
+    """Return text, an XML text or attribute value, as gdata stores it.
+    Args:
+        text: string
+    Returns:
+        string, encoded with atom.MEMBER_STRING_ENCODING, utf-8 if atom is
+        not imported, see --offline. None if empty.
+    """
+    if not text:
+        return None
+    encoding = 'utf-8'
+    if atom is not None:
+        encoding = atom.MEMBER_STRING_ENCODING
+    if encoding is unicode:
+        return text
+    return text.encode(encoding)
+
+
+def option_parser():
+    """Return the command line option parser.
+    Returns:
+        OptionParser instance
+    """
+    usage = "usage: %prog [options] [query]"
+    parser = OptionParser(usage=usage, option_class=MyOption)
+
+    parser.add_option("-a", "--account", dest="account",
+        help="The gmail account email address.")
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+        default=0, help="Update events with batch requests of this size.")
+    parser.add_option('-c', '--calendar', dest='calendars', action='append',
+        help="Id of a calendar. Repeat for several calendars. \
+            Default 'default'.")
+    parser.add_option('--daemon', dest='daemon', action='store_true',
+        help="Serve queries from memory, see --full-help.")
+    parser.add_option('-d', '--days', dest='days', type='int',
+        help="Display calendar entries for this many days.")
+    parser.add_option("-e", "--edit", dest="edit", action="store_true",
+        help="Edit calendar events.")
+    parser.add_option('-f', '--from-date', dest='from_date', type='date',
+        help="Display calendar entries from this date. yyyy-mm-dd")
+    parser.add_option('--full-help', dest='full_help',
+        action='store_true',
+        help='Print full help and exit. Full help includes examples/notes.')
+    parser.add_option('-i', '--id', dest='id', type='str',
+        help="Id of calendar entry")
+    parser.add_option('-l', '--limit', dest='limit', type='int',
+        help="Print at most this many events.")
+    parser.add_option('--list-calendars', dest='list_calendars',
+        action='store_true', help="Print the calendars of the account.")
+    parser.add_option('--match', dest='match',
+        choices=('prefix', 'word', 'regex'), default='regex',
+        help="Keyword match. One of 'regex', 'prefix' or 'word'. \
+            Default 'regex', the keyword is a regular expression searched \
+            for in the what and description. 'prefix' and 'word' use the \
+            query syntax and the keyword index.")
+    parser.add_option('--max-requests', dest='max_requests', type='int',
+        default=gservice.MAX_REQUESTS, help="Most requests to google at once. \
+            Default {max}.".format(max=gservice.MAX_REQUESTS))
+    parser.add_option('-m', '--mode', dest='mode',
+        choices=('long', 'short', 'jsonl', 'csv', 'ics'), default='long',
+        help="Mode. One of 'short', 'long', 'jsonl', 'csv' or 'ics' mode. \
+            Default 'long'.")
+    parser.add_option('--no-cache', dest='cache', action='store_false',
+        default=True, help="Do not use the local event cache.")
+    parser.add_option('--offline', dest='offline', action='store_true',
+        help="Print events from the local event cache without syncing it \
+            with google calendar.")
+    parser.add_option('--rate', dest='rate', type='float',
+        default=gservice.REQUEST_RATE, help="Most requests to google \
+            started per second, 0 for no limit. Default {rate}.".format(
+            rate=gservice.REQUEST_RATE))
+    parser.add_option('-r', '--refresh', dest='refresh', action='store_true',
+        default=False, help="Rebuild the local event cache.")
+    sort_choices = ('id', 'what', 'where', 'when', 'until', 'description')
+    parser.add_option('-s', '--sort', dest='sort',
+        choices=sort_choices,
+        default='when',
+        help=' '.join(['Field to sort by.',
+            'One of: {opts}'.format(opts=sort_choices),
+            "Default 'when'."]))
+    parser.add_option('-t', '--to-date', dest='to_date', type='date',
+        help="Display calendar entries up to this date. yyyy-mm-dd")
+    parser.add_option("-v", "--verbose",
+        action="store_true", dest="verbose", default=False,
+        help="Print messages to stdout.")
+    parser.add_option('--vv', action='store_const', const=2,
+        dest='verbose', help='More verbose.')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        default=1, help="Number of events to update concurrently. Default 1.")
+    return parser
+
+
+def parse_entries(source, feed=None):
+    """Generator of the calendar event entries of Atom XML.
+    Args:
+        source: file like object, a feed or a single entry
+        feed: dictionary, if not None, 'total' is set to the
+            openSearch:totalResults of the feed, if it has one.
+    Returns:
+        Generator of dictionaries with the keys id, what, description,
+        where, reminders, start and end. start and end are google
+        timestamps.
+
+    Notes:
+        The XML is parsed incrementally and each entry element is cleared
+        once read so memory use does not grow with the number of entries.
+        This is much faster than building gdata CalendarEventEntry
+        objects but the records are read only, see Event(record=...).
+    """
+    root = None
+    for action, elem in ElementTree.iterparse(source, events=('start',
+            'end')):
+        if root is None:
+            root = elem
+        if action != 'end':
+            continue
+        if elem.tag in TOTAL_RESULTS and feed is not None and elem.text:
+            feed['total'] = int(elem.text)
+        if elem.tag != ATOM_NS + 'entry':
+            continue
+        record = entry_record(elem)
+        elem.clear()
+        if root is not elem:
+            root.clear()
+        yield record
+
+
+def print_offline(options, keyword, email):
+    """Print events from the event caches without syncing them.
+    Args:
+        options: optparse Values, command line options
+        keyword: string, keyword or query the events are filtered on
+        email: string, email address of the account
+
+    Notes:
+        Only the modules needed to read the cache are imported, see
+        import_modules(). gdata is not imported and google is not
+        contacted.
+    """
+    calendars = []
+    for calendar_id in options.calendars or ['default']:
+        cache = EventCache(filename=cache_filename(email, calendar_id))
+        cache.load()
+        calendar = Calendar(cache=cache, calendar_id=calendar_id)
+        calendar.detached = True
+        calendar.offline = True
+        calendar.set_query_filters(from_date=options.from_date,
+            to_date=options.to_date, days=options.days)
+        calendars.append(calendar)
+    if len(calendars) > 1:
+        events = fetch_calendars(calendars, keyword=keyword,
+            match_id=options.id, match=options.match)
+    else:
+        events = calendar.filter(calendar.get(), keyword=keyword,
+            match_id=options.id, match=options.match)
+    calendar.print_events(events, mode=options.mode, sort_by=options.sort,
+        limit=options.limit)
+
+
+def tokenize(texts):
+    """Split texts into lower case words.
+    Args:
+        texts: list of strings, None values are ignored
+    Returns:
+        list of strings
+    """
+    words = []
+    for text in texts:
+        if text:
+            words.extend(P_WORD.findall(text.lower()))
+    return words
+
+
 def usage_full():
     """Return a string representing the full usage text."""
 
@@ -815,6 +3355,34 @@ OPTIONS:
 
             gcalendar.py --account username@gmail.com
 
+    -b, --batch-size
+        When editing, send calendar event changes to google in batch
+        requests of up to this many events. Adds, updates and deletes are
+        combined in each batch. Failures are reported per event. The default,
+        0, sends one request per event change.
+
+    -c, --calendar
+        The id of a calendar to print or edit, see --list-calendars. Repeat
+        the option to print the events of several calendars. They are
+        fetched concurrently and printed in one list, each event tagged
+        with its calendar id. Only one calendar can be edited at a time.
+        The default is 'default', the primary calendar of the account.
+
+            gcalendar.py -c default -c team@group.calendar.google.com
+
+    --daemon
+        Run in the foreground as a daemon serving queries from memory. See
+        DAEMON below. The calendars given with --calendar are loaded on
+        start, others when first queried.
+
+            gcalendar.py --daemon &
+
+    -d, --days
+        Print or edit calendar events for this many days, starting with the
+        --from-date, or today. If provided, --to-date is ignored.
+
+            gcalendar.py --days 1       # Today's events
+
     -e, --edit
         Edit calendar events. By default events are printed to stdout. The edit
         option permits creating, updating and deleting calendar events.
@@ -832,12 +3400,66 @@ OPTIONS:
         Print or edit a single calendar event identified by the given
         id.
 
+    -l, --limit
+        Print at most this many calendar events, the first ones in sort
+        order. Only the events printed are sorted, so listing the next few
+        events of a large calendar is fast.
+
+    --list-calendars
+        Print the id and title of each calendar of the account and exit.
+
+    --match
+        The match option indicates how the query is matched against
+        calendar events.
+            Choices:
+                regex       the query is a regular expression searched for
+                            in the event what or description, eg 'entist'
+                            matches 'Dentist'
+                prefix      query words match the start of event words
+                word        query words match whole event words
+        The default is 'regex'. With 'prefix' and 'word' the query syntax,
+        see QUERIES below, is used and the what, description and where are
+        searched. If the query is not valid query syntax, 'regex' is used.
+
+    --max-requests
+        The most requests to google calendar in progress at once. Feed
+        pages, the calendars given with --calendar and, with --workers,
+        event updates are requested concurrently, up to this limit. The
+        default is 8. See --rate.
+
     -m, --mode
         The mode option indicates the format of the printed output. The
         default is 'long'.
             Choices:
                 long        mulitiple lines per event, one line per attribute
                 short       one line per event
+                jsonl       one JSON object per line
+                csv         comma separated values with a header row
+                ics         iCalendar (RFC 5545), events without a start
+                            time are skipped
+        The jsonl, csv and ics modes are for other programs. Events are
+        written as they are read, a page at a time with --no-cache.
+
+    --no-cache
+        Query google calendar directly and do not use the local event cache.
+        See CACHE below.
+
+    --offline
+        Print events from the local event cache without syncing it with
+        google calendar. The script does not log in or import gdata, so it
+        starts quickly. Events may be out of date. Not for edits.
+
+    --rate
+        The most requests to google calendar started per second. The
+        default is 10. Use 0 for no limit. If google refuses a request for
+        quota, the number of requests in progress and the rate are halved
+        and the request is retried after a random delay that doubles with
+        each retry. Both recover as requests succeed, up to --max-requests
+        and --rate.
+
+    -r, --refresh
+        Discard the local event cache and fetch all events from google
+        calendar.
 
     -s, --sort,
         The sort option indicates how to sort calendar events when
@@ -860,6 +3482,11 @@ OPTIONS:
     -v, --verbose,
         Print information messages to stdout.
 
+    -w, --workers
+        The number of calendar events, or batches if --batch-size is used,
+        to update concurrently when editing. The default is 1, events are
+        updated one at a time.
+
     --vv
         More verbose. Print debugging messages to stdout.
 
@@ -872,12 +3499,79 @@ NOTES:
 
     When editing calendar events, a list of events is stored in a temp
     file and the file is opened in the vim editor. If you quit without
-    saving, no updates are made. If you save, all events in the file
-    are updated.
-
-    If changes to only a few events are made, it's possible to speed up the
-    update by removing everything from the file but the information for
-    the events that are changed.
+    saving, no updates are made. If you save, only events that were added,
+    changed or deleted are updated. Removing an event from the file does not
+    delete it.
+
+
+QUERIES:
+    Calendar events printed or edited can be limited with a keyword. By
+    default the keyword is a regular expression. With --match prefix or
+    --match word, the keyword is a query, one or more terms combined with
+    the operators AND, OR and NOT.
+
+        dentist             events with a word starting with 'dentist' in
+                            the what, description or where
+        "dr. crest"         events with the phrase 'dr. crest' in the what,
+                            description or where
+        what:hockey         the term is matched against the what only.
+                            Fields: what, where, desc, remind
+        hockey game         events matching both terms, same as
+                            hockey AND game
+        hockey OR frisbee   events matching either term
+        NOT game, -game     events not matching the term
+        (a OR b) c          parentheses group terms
+
+    AND binds more tightly than OR. Operators must be upper case. Matching is
+    case insensitive. A query which is not valid query syntax, eg 'den.ist',
+    is matched as a regular expression against the what and description.
+
+    With --no-cache and --match word, the words every matching event must
+    contain are sent to google as a full text query, so fewer events are
+    downloaded. The query is still matched exactly as described above.
+
+    With --no-cache, only the parts of each event needed are requested,
+    eg the what and when in short mode. All responses are requested gzip
+    compressed.
+
+
+CACHE:
+    Calendar events are cached in the file
+    $HOME/.cache/gcalendar/<account>.events, or
+    $HOME/.cache/gcalendar/<account>.<calendar>.events for calendars other
+    than the default. The first time the script is run,
+    all events are fetched from google calendar and stored in the cache. On
+    subsequent runs only events added, changed or deleted since the last run
+    are fetched and merged into the cache. The --from-date, --to-date and
+    --days filters are applied to the cached events locally using an index
+    sorted by start time, so changing the date range does not require
+    fetching events again.
+
+    Use --refresh to rebuild the cache from scratch, or --no-cache to bypass
+    it. Use --offline to print events from the cache as it is.
+
+    Syncs are conditional requests. If no event has changed since the
+    last sync, google replies 304 Not Modified without a feed and the
+    cache is used as it is. Cached events keep their etags, so an event
+    changed by someone else while being edited is refreshed with a
+    conditional request and the edit applied to the current version.
+
+    If numpy is installed, the start and end times of large caches are
+    converted to local time, filtered and sorted in bulk.
+
+
+DAEMON:
+    With --daemon the script logs in once, keeps the events of each
+    calendar queried in memory and syncs them with google calendar every
+    five minutes. It serves queries on the unix socket
+    $HOME/.cache/gcalendar/daemon.sock, accessible only by the user.
+
+    While a daemon is running, the script passes its options to the daemon
+    and prints the events the daemon sends back, without logging in or
+    reading the cache. Events may be up to five minutes out of date.
+    Edits, --list-calendars, --no-cache and --refresh are always run
+    directly, as is any query if no daemon is running. A daemon started
+    with --account only serves queries given the same --account.
 
 
 EVENT ATTRIBUTES:
@@ -891,7 +3585,7 @@ EVENT ATTRIBUTES:
     what
         Required: No, but recommended.
         Format: string
-        Default: _new_event
+        Default: empty string
         Example: Dentist appointment.
 
     where
@@ -957,9 +3651,18 @@ EXAMPLES:
     # Display calendar events keyword 'dentist'
     gcalendar.py dentist
 
+    # Display hockey or frisbee games not at the arena
+    gcalendar.py '(hockey OR frisbee) game -where:arena'
+
     # Display all calendar events, short format sorted by "what"
     gcalendar.py -m short -s what
 
+    # Display the next 10 calendar events
+    gcalendar.py -m short -l 10
+
+    # Export calendar events to another calendar application
+    gcalendar.py -m ics > calendar.ics
+
     # Edit calendar events
     gcalendar.py -e
 
@@ -1011,6 +3714,14 @@ CONFIGURATION:
         macdef calendar_account
             username@gmail.com
 
+    Auth token
+
+    After logging in, the auth token is saved in
+    $HOME/.cache/gcalendar/<account>.token, readable only by the user, and
+    used instead of logging in for up to a week. The password is not read
+    while the token is in use. If google rejects the token the script logs
+    in again. Delete the file to force a new login.
+
 
 REQUIREMENTS:
 
@@ -1022,6 +3733,20 @@ REQUIREMENTS:
 """
 
 
+def utf8(text):
+    """Return text utf-8 encoded.
+    Args:
+        text: string or unicode, or None
+    Returns:
+        string, '' if text is None
+    """
+    if text is None:
+        return ''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
 def main():
     """ Main routine.
     Args:
@@ -1030,40 +3755,12 @@ def main():
         None.
     """
 
-    usage = "usage: %prog [options] [keyword]"
-    parser = OptionParser(usage=usage, option_class=MyOption)
-
-    parser.add_option("-a", "--account", dest="account",
-        help="The gmail account email address.")
-    parser.add_option("-e", "--edit", dest="edit", action="store_true",
-        help="Edit calendar events.")
-    parser.add_option('-f', '--from-date', dest='from_date', type='date',
-        help="Display calendar entries from this date. yyyy-mm-dd")
-    parser.add_option('--full-help', dest='full_help',
-        action='store_true',
-        help='Print full help and exit. Full help includes examples/notes.')
-    parser.add_option('-i', '--id', dest='id', type='str',
-        help="Id of calendar entry")
-    parser.add_option('-m', '--mode', dest='mode',
-        choices=('long', 'short'), default='long',
-        help="Mode. One of 'short' or 'long' mode. Default 'long'.")
-    sort_choices = ('id', 'what', 'where', 'when', 'until', 'description')
-    parser.add_option('-s', '--sort', dest='sort',
-        choices=sort_choices,
-        default='when',
-        help=' '.join(['Field to sort by.',
-            'One of: {opts}'.format(opts=sort_choices),
-            "Default 'when'."]))
-    parser.add_option('-t', '--to-date', dest='to_date', type='date',
-        help="Display calendar entries up to this date. yyyy-mm-dd")
-    parser.add_option("-v", "--verbose",
-        action="store_true", dest="verbose", default=False,
-        help="Print messages to stdout.")
-    parser.add_option('--vv', action='store_const', const=2,
-        dest='verbose', help='More verbose.')
-
+    parser = option_parser()
     (options, args) = parser.parse_args()
 
+    if options.edit and options.calendars and len(options.calendars) > 1:
+        parser.error('Only one calendar can be edited at a time.')
+
     if options.verbose > 0:
         if options.verbose == 1:
             LOG.setLevel(logging.INFO)
@@ -1076,9 +3773,23 @@ def main():
         print usage_full()
         exit(0)
 
+    if options.daemon and not options.cache:
+        parser.error('The daemon requires the event cache.')
+
+    if options.offline and (options.edit or options.list_calendars or
+            options.daemon or options.refresh or not options.cache):
+        parser.error('Offline, events can only be printed from the cache.')
+
+    # Run the query with the daemon if one is running. The daemon declines
+    # queries it can not run, eg edits.
+    if not options.daemon and daemon_query(sys.argv[1:]):
+        return
+
+    import_modules(offline=options.offline)
+
     keyword = None
     if len(args) > 0:
-        keyword = args[0]
+        keyword = ' '.join(args)
 
     if options.account:
         email = options.account
@@ -1089,37 +3800,72 @@ def main():
         print >> sys.stderr, msg
         quit(1)
 
-    password = get_password(email)
-
     LOG.debug("email: {email}".format(email=email))
-    LOG.debug("password: {pw}".format(pw=password))
+
+    if options.offline:
+        print_offline(options, keyword, email)
+        return
 
     LOG.debug("Creating google calendar service.")
-    gd_client = gdata.calendar.service.CalendarService()
+    gd_client = CalendarService(token_cache=gservice.TokenCache(
+        filename=os.path.join(CACHE_DIR, '{email}.token'.format(
+        email=email))), governor=gservice.Governor(
+        max_requests=options.max_requests, max_rate=options.rate))
 
-    LOG.debug("Logging in.")
     gd_client.email = email
-    gd_client.password = password
     gd_client.source = 'Google-Calendar_Python_Sample-1.0'
-    gd_client.ProgrammaticLogin()
+    gd_client.login()
+
+    if options.list_calendars:
+        for calendar_id, title in list_calendars(gd_client):
+            print '{id}\t{title}'.format(id=calendar_id, title=title)
+        return
+
+    if options.daemon:
+        daemon = Daemon(gd_client, email,
+            default_account=not options.account, refresh=options.refresh)
+        daemon.serve(calendar_ids=options.calendars)
+        return
 
     LOG.debug("Getting calendar feed.")
 
-    calendar = Calendar(gd_client=gd_client)
-    calendar.set_query_filters(from_date=options.from_date,
-        to_date=options.to_date)
-    calendar.get()
-    calendar.filter(keyword=keyword, match_id=options.id)
+    calendars = []
+    for calendar_id in options.calendars or ['default']:
+        cache = None
+        if options.cache:
+            cache = EventCache(filename=cache_filename(email, calendar_id))
+            if not options.refresh:
+                cache.load()
+        calendar = Calendar(gd_client=gd_client, cache=cache,
+            calendar_id=calendar_id)
+        # Entries are only needed to update events.
+        calendar.detached = not options.edit
+        calendar.set_query_filters(from_date=options.from_date,
+            to_date=options.to_date, days=options.days)
+        calendar.set_text_query(keyword=keyword, match=options.match)
+        calendar.set_fields(mode=options.mode, keyword=keyword,
+            sort_by=options.sort)
+        calendars.append(calendar)
+
+    if len(calendars) > 1:
+        events = fetch_calendars(calendars, keyword=keyword,
+            match_id=options.id, match=options.match)
+    else:
+        events = calendar.filter(calendar.get(), keyword=keyword,
+            match_id=options.id, match=options.match)
     if options.edit:
         # All details are required for edit. Force long mode.
         options.mode = 'long'
     if options.edit:
         LOG.debug("Editing events.")
-        calendar.edit()
-        calendar.update()
+        calendar.edit(events)
+        calendar.update(workers=options.workers,
+            batch_size=options.batch_size)
     else:
         LOG.debug("Printing events.")
-        calendar.print_events(mode=options.mode, sort_by=options.sort)
+        calendar.print_events(events, mode=options.mode, sort_by=options.sort,
+            limit=options.limit)
+    gd_client.log_stats()
 
 
 class MyOption (Option):
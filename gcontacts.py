@@ -18,22 +18,25 @@ __contributors__ = ["Patrick Brisbin (abook and bug fixes)"]
 # W0404: *Reimport %r (imported line %s)*
 # pylint: disable=W0404
 from optparse import OptionParser
-import atom
-import email.parser
-import email.utils
+import cPickle
 import filecmp
-import gdata.contacts
-import gdata.contacts.service
 import getpass
+import gservice
 import logging
 import netrc
 import os
 import re
-import shutil
-import subprocess
 import sys
-import tempfile
-
+import threading
+# Imported by import_modules() so --help does not pay for them.
+atom = None
+email = None
+gdata = None
+shutil = None
+subprocess = None
+tempfile = None
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gcontacts')
 CONTACTS_MACRO = 'contacts_account'
 P_ID = re.compile(r'^http://www.google.com/m8/feeds/contacts/.*?/base/(.*)$')
 P_REL = re.compile(r'^http://schemas.google.com/g/2005#(.*)$')
@@ -47,12 +50,14 @@ LOG = logging.getLogger('')
 
 class Contacts():
     """Class representing a set of contacts."""
-    def __init__(self, gd_client=None):
+    def __init__(self, gd_client=None, feed_cache=None):
         self.gd_client = gd_client
+        self.feed_cache = feed_cache    # FeedCache instance or None
         self.query = gdata.contacts.service.ContactsQuery()
         self.query.max_results = 999999
-        self.feed = gd_client.GetContactsFeed(self.query.ToUri())
+        self.feed = self.get_feed(self.query.ToUri())
         self.contacts = []
+        self.lock = threading.Lock()    # Guards contacts during update()
         self.filtered_contacts = []
         self.filename = ''
 
@@ -213,6 +218,37 @@ class Contacts():
             contact = Contact(entry=entry)
             self.contacts.append(contact)
 
+    def get_feed(self, uri):
+        """Get the contacts feed.
+        Args:
+            uri: string, uri of the feed
+        Returns:
+            ContactsFeed instance
+
+        Notes:
+            If there is a feed cache, the request is conditional on the
+            validators of the cached feed. If the feed is unchanged, google
+            replies 304 Not Modified and the cached feed is used.
+        """
+        if not self.feed_cache:
+            return self.gd_client.GetContactsFeed(uri)
+        cached = self.feed_cache.load()
+        validators = None
+        if cached.get('uri') == uri:
+            validators = cached['validators']
+        try:
+            body, validators = self.gd_client.get_conditional(uri,
+                validators=validators, converter=lambda body: body)
+        except gdata.service.RequestError as err:
+            if err.args[0]['status'] != 304:
+                raise
+            LOG.debug("Contacts unchanged, using cached feed.")
+            body = cached['body']
+        else:
+            self.feed_cache.save({'uri': uri, 'validators': validators,
+                'body': body})
+        return gdata.contacts.ContactsFeedFromString(body)
+
     def print_contacts(self, mode='long', sort_by='email', print_status=False):
         """ Print contacts.
         Args:
@@ -352,13 +388,21 @@ class Contacts():
                     print "phone_{rel}: {num}".format(rel=phone['rel'],
                             num=phone['number'])
 
-    def update(self):
-        """Update contacts from file. """
+    def update(self, workers=1):
+        """Update contacts from file.
+        Args:
+            workers: integer, number of contacts to update concurrently.
+        """
         if not self.filename:
             return
-        for info in self.update_generator():
-            if not self.update_contact(info):
+        blocks = list(self.update_generator())
+        results = gservice.map_concurrent(self.update_contact, blocks,
+            workers=workers)
+        for info, (result, error) in zip(blocks, results):
+            if error or not result:
                 print >> sys.stderr, 'Contact update failed:'
+                if error:
+                    print >> sys.stderr, error
                 print >> sys.stderr, info
         return
 
@@ -384,16 +428,20 @@ class Contacts():
         if action == 'add':
             # Add a blank contact and then continue as if updating.
             contact = self.add_blank_contact()
-            self.contacts.append(contact)
+            with self.lock:
+                self.contacts.append(contact)
             if contact.entry.id:
                 match = P_ID.match(contact.entry.id.text)
                 if match:
                     attributes['id'] = match.group(1)
             action = 'update'
 
-        # Find the matching contact
+        # Find the matching contact. Other contacts may be added meanwhile,
+        # see update().
+        with self.lock:
+            contacts = list(self.contacts)
         contact = None
-        for c in self.contacts:
+        for c in contacts:
             match = P_ID.match(c.entry.id.text)
             if match:
                 if attributes['id'] == match.group(1):
@@ -549,6 +597,46 @@ class Contact():
             self.fullname = 'n/a'
 
 
+# Defined by import_modules().
+ContactsService = None
+
+
+class FeedCache():
+    """Class representing a persistent copy of a feed.
+
+    The cache is a dictionary with the uri of the feed, the validators of
+    the response, see ContactsService.get_conditional(), and the body of
+    the feed. It is stored in a file only readable by the user.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+
+    def load(self):
+        """Load the cache from file.
+        Returns:
+            dictionary, empty if there is no cache.
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'rb') as f:
+                return cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError) as err:
+            LOG.warn('Unable to read feed cache {file}. {reason}'.format(
+                file=self.filename, reason=str(err)))
+            return {}
+
+    def save(self, data):
+        """Save the cache to file.
+        Args:
+            data: dictionary, with uri, validators and body keys
+        """
+        if not self.filename:
+            return
+        gservice.atomic_write(self.filename,
+            cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL), 'wb')
+
+
 def get_email_address():
     """ Get the google email address associated with Google contacts.
     Args:
@@ -606,6 +694,47 @@ def get_password(email_address):
     return getpass.getpass()
 
 
+def import_modules():
+    """Import the modules deferred at start up and define the classes
+    derived from gdata and atom classes, eg ContactsService.
+
+    Notes:
+        Call before talking to google contacts. --help and --full-help
+        start without importing gdata. To check:
+
+            python -v gcontacts.py --help 2>&1 | grep gdata
+    """
+    # W0603: *Using the global statement*
+    # W0621: *Redefining name %r from outer scope*
+    # pylint: disable=W0603,W0621
+    global atom, email, gdata, shutil, subprocess, tempfile, \
+        ContactsService
+    if ContactsService is not None:
+        return
+    import atom
+    import email.parser
+    import email.utils
+    import gdata.contacts
+    import gdata.contacts.service
+    import gdata.service
+    import shutil
+    import subprocess
+    import tempfile
+    gservice.import_modules()
+
+    class ContactsService(gservice.GovernedServiceMixin,
+            gdata.contacts.service.ContactsService):
+        """Class representing a Google contacts service client, see
+        gservice.GovernedServiceMixin.
+
+        Requests may be sent from several threads at once, eg contact
+        updates.
+        """
+        def lookup_password(self):
+            """Return the password of the account, see get_password()."""
+            return get_password(self.email)
+
+
 def usage_full():
     """Return a string representing the full usage text."""
 
@@ -644,6 +773,10 @@ OPTIONS:
     -f, --full-help
         Print this full help and exit. Full help includes examples and notes.
 
+    --max-requests
+        The most requests to google contacts in progress at once. The
+        default is 8. See --rate.
+
     -m, --mode
         The mode option indicates the format of the printed output.
             Choices:
@@ -653,6 +786,14 @@ OPTIONS:
                 long        mulitiple lines per contact, one line per attribute
                 short       one line per contact
 
+    --rate
+        The most requests to google contacts started per second. The
+        default is 10. Use 0 for no limit. If google refuses a request for
+        quota, the number of requests in progress and the rate are halved
+        and the request is retried after a random delay that doubles with
+        each retry. Both recover as requests succeed, up to --max-requests
+        and --rate.
+
     -r, --include-header
         If the include-header option is provided, a status header is printed
         before the list of contacts.
@@ -667,6 +808,10 @@ OPTIONS:
     -v, --verbose,
         Print information messages to stdout.
 
+    -w, --workers
+        The number of contacts to update concurrently when editing. The
+        default is 1, contacts are updated one at a time.
+
     --vv
         More verbose. Print debugging messages to stdout.
 
@@ -763,6 +908,22 @@ CONFIGURATION:
         macdef contacts_account
             username@gmail.com
 
+    Auth token
+
+    After logging in, the auth token is saved in
+    $HOME/.cache/gcontacts/<account>.token, readable only by the user, and
+    used instead of logging in for up to a week. The password is not read
+    while the token is in use. If google rejects the token the script logs
+    in again. Delete the file to force a new login.
+
+    Feed cache
+
+    The contacts feed is saved in $HOME/.cache/gcontacts/<account>.contacts
+    with its ETag and Last-Modified values. The feed is requested on
+    condition it changed since, so if no contact has changed google replies
+    304 Not Modified and the saved feed is used instead of downloading it
+    again. Delete the file to force a full download.
+
     Mutt
 
     The gcontacts.py script can be used as an address book for mutt.
@@ -817,10 +978,17 @@ def main():
     parser.add_option("-f", "--full-help", dest="full_help",
         action="store_true",
         help="Print full help and exit. Full help includes examples/notes.")
+    parser.add_option('--max-requests', dest='max_requests', type='int',
+        default=gservice.MAX_REQUESTS, help="Most requests to google at once. \
+            Default {max}.".format(max=gservice.MAX_REQUESTS))
     parser.add_option('-m', '--mode', dest='mode',
         choices=('abook', 'email', 'long', 'short'), default='long',
         help="Mode. One of: 'abook', 'email', 'long', or 'short'. \
             Default: 'long'")
+    parser.add_option('--rate', dest='rate', type='float',
+        default=gservice.REQUEST_RATE, help="Most requests to google \
+            started per second, 0 for no limit. Default {rate}.".format(
+            rate=gservice.REQUEST_RATE))
     parser.add_option('-r', '--include-header', dest='print_status',
         action='store_true', default=False,
         help="Include a status header line. (Required for mutt)")
@@ -832,6 +1000,9 @@ def main():
         help='Print messages to stdout.',)
     parser.add_option('--vv', action='store_const', const=2,
         dest='verbose', help='More verbose.')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+        default=1, help="Number of contacts to update concurrently. \
+            Default 1.")
 
     (options, args) = parser.parse_args()
 
@@ -847,6 +1018,8 @@ def main():
         print usage_full()
         exit(0)
 
+    import_modules()
+
     keyword = None
     if len(args) > 0:
         keyword = args[0]
@@ -860,25 +1033,25 @@ def main():
         print >> sys.stderr, msg
         quit(1)
 
-    password = get_password(email_addr)
-
-    LOG.debug("email: {email} password: {pw}".format(email=email_addr,
-        pw=password))
+    LOG.debug("email: {email}".format(email=email_addr))
 
     LOG.debug("Creating google contacts service.")
-    gd_client = gdata.contacts.service.ContactsService()
+    gd_client = ContactsService(token_cache=gservice.TokenCache(
+        filename=os.path.join(CACHE_DIR, '{email}.token'.format(
+        email=email_addr))), governor=gservice.Governor(
+        max_requests=options.max_requests, max_rate=options.rate))
 
-    LOG.debug("Logging in.")
     gd_client.email = email_addr
-    gd_client.password = password
     gd_client.source = 'dm-contacts-1'
-    gd_client.ProgrammaticLogin()
+    gd_client.login()
 
     if options.edit:
         # All details are required for edit. Force long mode.
         options.mode = 'long'
 
-    contact_set = Contacts(gd_client=gd_client)
+    contact_set = Contacts(gd_client=gd_client, feed_cache=FeedCache(
+        filename=os.path.join(CACHE_DIR, '{email}.contacts'.format(
+        email=email_addr))))
 
     if options.create:
         contact_set.create_contact_from_file(options.create)
@@ -887,10 +1060,11 @@ def main():
         contact_set.filter(keyword)
         if options.edit:
             contact_set.edit()
-            contact_set.update()
+            contact_set.update(workers=options.workers)
         else:
             contact_set.print_contacts(mode=options.mode, sort_by=options.sort,
                 print_status=options.print_status)
+    gd_client.log_stats()
 
 if __name__ == '__main__':
     main()
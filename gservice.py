@@ -0,0 +1,547 @@
+"""
+Google data service helpers shared by gcalendar.py and gcontacts.py.
+
+The scripts derive their service classes, eg CalendarService, from
+GovernedServiceMixin and a gdata service class, and send their requests
+through the governor, pooled http client and token cache defined here.
+"""
+# W0404: *Reimport %r (imported line %s)*
+# pylint: disable=W0404
+import logging
+import os
+import Queue
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+# Imported by import_modules() so --help does not pay for them.
+atom = None
+gdata = None
+httplib = None
+socket = None
+zlib = None
+
+BACKOFF = 1.0             # Seconds, longest wait before a first retry
+MAX_BACKOFF = 60.0        # Seconds, longest wait before any retry
+MAX_REQUESTS = 8          # Most requests to google in progress at once
+P_QUOTA = re.compile(r'quota|rate ?limit', re.IGNORECASE)
+REQUEST_RATE = 10.0       # Most requests to google started per second
+RETRIES = 6               # Most retries of a throttled request
+TOKEN_MAX_AGE = 7 * 86400  # Seconds a cached auth token is used
+LOG = logging.getLogger('')
+
+
+class GovernedServiceMixin(object):
+    """Class representing a google data service client that reuses its
+    auth token and sends its requests through a governor.
+
+    The ClientLogin auth token is cached in the token_cache. If a request
+    with a cached token is rejected, the client logs in again and the
+    request is repeated.
+
+    Requests may be sent from several threads at once. The governor limits
+    how many are in progress and how quickly they are started, and retries
+    requests refused for quota, see Governor.
+
+    Derive a service class from this class and a gdata service class, eg
+    gdata.calendar.service.CalendarService, in that order. The derived class
+    defines lookup_password(), see login().
+    """
+    def __init__(self, token_cache=None, governor=None, **kwargs):
+        governor = governor or Governor()
+        # There are never more connections in use than requests.
+        kwargs.setdefault('http_client',
+            PooledHttpClient(size=governor.max_requests))
+        super(GovernedServiceMixin, self).__init__(**kwargs)
+        self.token_cache = token_cache  # TokenCache instance or None
+        self.cached_token = False       # True if using a cached token
+        self.login_lock = threading.Lock()
+        self.governor = governor
+        self.local = threading.local()  # response, last response received
+                                        # by the thread
+
+    def get_conditional(self, uri, validators=None, converter=None,
+            extra_headers=None):
+        """Get a uri unless it is unchanged since a previous get.
+        Args:
+            uri: string, see gdata.service.GDataService.Get()
+            validators: dictionary, validators returned by a previous get
+                of the uri, None for an unconditional get
+            converter: function, see gdata.service.GDataService.Get()
+            extra_headers: dictionary, more headers to send
+        Returns:
+            tuple, (result, validators), the result of Get() and a
+            dictionary of the 'etag' and 'modified' validators of the
+            response.
+        Raises:
+            gdata.service.RequestError, status 304 if the uri is unchanged.
+
+        Notes:
+            The request has If-None-Match and If-Modified-Since headers
+            from the validators, if they have values.
+        """
+        headers = dict(extra_headers or {})
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('modified'):
+            headers['If-Modified-Since'] = validators['modified']
+        result = self.Get(uri, extra_headers=headers, converter=converter)
+        response = self.local.response
+        return (result, {'etag': response.getheader('ETag'),
+            'modified': response.getheader('Last-Modified')})
+
+    def log_stats(self):
+        """Log the requests sent and the connections they used, see
+        PooledHttpClient."""
+        stats = self.http_client.stats
+        LOG.info(' '.join([
+            'Requests: {req},'.format(req=stats['requests']),
+            'connections opened: {opn},'.format(opn=stats['opened']),
+            'reused: {reu},'.format(reu=stats['reused']),
+            'stale: {stl}'.format(stl=stats['stale']),
+            ]))
+
+    def login(self, use_cache=True):
+        """Log in, reusing the cached auth token if there is one.
+        Args:
+            use_cache: If False, ignore the cached token.
+
+        Notes:
+            The password is only looked up, see lookup_password(), if there
+            is no cached token.
+        """
+        token = None
+        if use_cache and self.token_cache:
+            token = self.token_cache.load()
+        if token:
+            LOG.debug("Using cached auth token.")
+            self.SetClientLoginToken(token)
+            self.cached_token = True
+            return
+        if not self.password:
+            self.password = self.lookup_password()
+            LOG.debug("password: {pw}".format(pw=self.password))
+        LOG.debug("Logging in.")
+        self.ProgrammaticLogin()
+        self.cached_token = False
+        if self.token_cache:
+            self.token_cache.save(self.GetClientLoginToken())
+
+    def request(self, operation, url, data=None, headers=None,
+            url_params=None):
+        """Send a request through the governor, retrying if it is
+        throttled and logging in again if the cached token is rejected.
+
+        See atom.service.AtomService.request().
+        """
+        attempt = 0
+        while True:
+            self.governor.acquire()
+            throttled = False
+            try:
+                response = super(GovernedServiceMixin, self).request(
+                    operation, url, data=data, headers=headers,
+                    url_params=url_params)
+                throttled, response = self.governor.throttled(response)
+            finally:
+                self.governor.release(throttled=throttled)
+            if not throttled or attempt >= self.governor.retries:
+                break
+            response.read()
+            delay = self.governor.backoff(attempt)
+            LOG.info("Request throttled, {status} {reason}. Retrying in"
+                " {delay:.1f} seconds.".format(status=response.status,
+                reason=response.reason, delay=delay))
+            time.sleep(delay)
+            attempt += 1
+        if response.status != 401 or not self.cached_token:
+            self.local.response = response
+            return response
+        response.read()
+        with self.login_lock:
+            # Another thread may have logged in already.
+            if self.cached_token:
+                LOG.debug("Cached auth token rejected.")
+                # Drop the token so it is not reused if the login fails.
+                self.token_cache.clear()
+                self.login(use_cache=False)
+        return self.request(operation, url, data=data, headers=headers,
+            url_params=url_params)
+
+
+class Governor():
+    """Class representing a governor of the requests sent to google.
+
+    The governor limits the requests in progress to limit and the rate they
+    are started at to rate per second, with a token bucket. Both adapt to
+    quota responses: a throttled request halves them, and each run of limit
+    requests that are not throttled raises them again, up to max_requests
+    and max_rate. A throttled request is retried up to retries times after
+    an exponential backoff with full jitter.
+
+    A single governor is shared by all the threads sending requests.
+    """
+    def __init__(self, max_requests=MAX_REQUESTS, max_rate=REQUEST_RATE,
+            retries=RETRIES):
+        self.max_requests = max(max_requests, 1)
+        self.max_rate = max_rate     # None or 0 for no rate limit
+        self.retries = retries
+        self.limit = self.max_requests
+        self.rate = max_rate
+        self.active = 0              # Requests in progress
+        self.successes = 0           # Requests not throttled since the
+                                     # limit last changed
+        self.tokens = 1.0
+        self.updated = time.time()   # Time tokens was last updated
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request can be sent."""
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        while self.rate:
+            with self.condition:
+                now = time.time()
+                # The bucket holds at most a second of tokens.
+                self.tokens = min(max(self.rate, 1.0),
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self, attempt):
+        """Return the seconds to wait before retrying a request.
+        Args:
+            attempt: integer, number of retries so far
+        Returns:
+            float
+        """
+        return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+
+    def release(self, throttled=False):
+        """Release a request and adapt the limits to its response.
+        Args:
+            throttled: If True, the request was throttled.
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                if self.rate:
+                    self.rate = max(self.max_rate / 10.0, self.rate / 2.0)
+                self.successes = 0
+                LOG.debug("Throttled, limit {limit}, rate {rate}.".format(
+                    limit=self.limit, rate=self.rate))
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.successes = 0
+                    self.limit = min(self.max_requests, self.limit + 1)
+                    if self.rate:
+                        self.rate = min(self.max_rate,
+                            self.rate + self.max_rate / 10.0)
+            self.condition.notify_all()
+
+    # R0201: *Method could be a function*
+    # pylint: disable=R0201
+    def throttled(self, response):
+        """Return whether a response refuses a request for quota.
+        Args:
+            response: httplib.HTTPResponse instance
+        Returns:
+            tuple, (throttled, response), throttled is a boolean, response
+            is the response to use in place of the one given.
+
+        Notes:
+            503 and 429 responses are throttled. A 403 response is throttled
+            if its body mentions a quota or rate limit, otherwise it is a
+            permission error. The body of a 403 is read to tell, so a
+            ReadResponse is returned in its place.
+        """
+        if response.status in (429, 503):
+            return (True, response)
+        if response.status != 403:
+            return (False, response)
+        response = ReadResponse(response)
+        return (P_QUOTA.search(response.body) is not None, response)
+
+
+class ReadResponse():
+    """Class representing an http response whose body has been read.
+
+    The body is returned by read() as if it had not been read, see
+    Governor.throttled().
+    """
+    def __init__(self, response):
+        self.response = response
+        self.body = response.read()
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        """Return the value of a header, see httplib.HTTPResponse."""
+        return self.response.getheader(name, default)
+
+    def read(self):
+        """Return the body."""
+        body = self.body
+        self.body = ''
+        return body
+
+
+class TokenCache():
+    """Class representing a persistent auth token.
+
+    The token is stored in a file only readable by the user. A token older
+    than max_age seconds is not used.
+    """
+    def __init__(self, filename=None, max_age=TOKEN_MAX_AGE):
+        self.filename = filename
+        self.max_age = max_age
+
+    def clear(self):
+        """Remove the cached token."""
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def load(self):
+        """Load the token from file.
+        Returns:
+            string, the token. None if there is no current token.
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return None
+        try:
+            if time.time() - os.stat(self.filename).st_mtime > self.max_age:
+                LOG.debug("Cached auth token expired.")
+                return None
+            with open(self.filename) as f:
+                return f.read().strip() or None
+        except (IOError, OSError) as err:
+            LOG.warn('Unable to read token file {file}. {reason}'.format(
+                file=self.filename, reason=str(err)))
+            return None
+
+    def save(self, token):
+        """Save the token to file.
+        Args:
+            token: string, ClientLogin auth token
+        """
+        if not self.filename or not token:
+            return
+        atomic_write(self.filename, token)
+
+
+# Defined by import_modules().
+PooledHttpClient = None
+
+
+def atomic_write(filename, data, mode='w'):
+    """Write data to a file, replacing it in one step.
+    Args:
+        filename: string, name of file
+        data: string, contents of the file
+        mode: string, mode the file is opened in, 'w' or 'wb'
+
+    Notes:
+        The data is written to a temp file, only readable by the user, and
+        renamed so a reader never sees a partially written file. The
+        directory of the file is created if it does not exist.
+    """
+    file_dir = os.path.dirname(filename)
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir, 0700)
+    (tmp_file_h, tmp_filename) = tempfile.mkstemp(dir=file_dir)
+    with os.fdopen(tmp_file_h, mode) as f:
+        f.write(data)
+    os.rename(tmp_filename, filename)
+
+
+def import_modules():
+    """Import the modules deferred at start up and define the classes
+    derived from atom classes, eg PooledHttpClient.
+
+    Notes:
+        Called by the import_modules() of gcalendar.py and gcontacts.py.
+    """
+    # W0603: *Using the global statement*
+    # W0621: *Redefining name %r from outer scope*
+    # pylint: disable=W0603,W0621
+    global atom, gdata, httplib, socket, zlib, PooledHttpClient
+    if PooledHttpClient is not None:
+        return
+    import atom
+    import atom.http
+    import gdata.service
+    import httplib
+    import socket
+    import zlib
+
+    class PooledHttpClient(atom.http.ProxiedHttpClient):
+        """Class representing an http client that keeps connections open
+        and reuses them.
+
+        Up to size idle connections are kept per host. The body of each
+        response is read before the response is returned, see ReadResponse,
+        so the connection can be reused at once. If a reused connection
+        fails before a response is received, eg the server closed it while
+        idle, the request is sent again on a new connection.
+
+        The stats property counts the requests sent, the connections
+        opened, the requests sent on a reused connection and the reused
+        connections that failed.
+        """
+        def __init__(self, size=MAX_REQUESTS, headers=None):
+            atom.http.ProxiedHttpClient.__init__(self, headers=headers)
+            self.size = size
+            self.idle = {}           # Lists of idle connections by host
+            self.lock = threading.Lock()
+            self.local = threading.local()
+            self.stats = {'requests': 0, 'opened': 0, 'reused': 0,
+                'stale': 0}
+
+        def _prepare_connection(self, url, headers):
+            """Return an idle connection to the host of the url, or a new
+            one. See atom.http.HttpClient."""
+            key = (url.protocol, url.host, url.port)
+            connection = None
+            with self.lock:
+                if self.local.reuse and self.idle.get(key):
+                    connection = self.idle[key].pop()
+                    self.stats['reused'] += 1
+                else:
+                    self.stats['opened'] += 1
+            self.local.reused = connection is not None
+            if connection is None:
+                connection = atom.http.ProxiedHttpClient._prepare_connection(
+                    self, url, headers)
+            self.local.key = key
+            self.local.connection = connection
+            return connection
+
+        def release(self, response):
+            """Read the response and keep its connection for reuse.
+            Args:
+                response: httplib.HTTPResponse instance
+            Returns:
+                ReadResponse instance, with the body decompressed if it is
+                gzip encoded.
+            """
+            connection = self.local.connection
+            try:
+                response = ReadResponse(response)
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                raise
+            if response.getheader('Content-Encoding') == 'gzip':
+                response.body = zlib.decompress(response.body,
+                    16 + zlib.MAX_WBITS)
+            if response.response.will_close:
+                connection.close()
+                return response
+            with self.lock:
+                idle = self.idle.setdefault(self.local.key, [])
+                if len(idle) < self.size:
+                    idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+            return response
+
+        def request(self, operation, url, data=None, headers=None):
+            """Send a request, reusing a connection if one is idle.
+
+            See atom.http.HttpClient.request().
+
+            Notes:
+                Responses are requested gzip compressed. Google only
+                compresses them if the user agent also mentions gzip.
+            """
+            headers = dict(headers or {})
+            headers['Accept-Encoding'] = 'gzip'
+            if 'gzip' not in headers.get('User-Agent', ''):
+                headers['User-Agent'] = '{agent} (gzip)'.format(
+                    agent=headers.get('User-Agent', 'python'))
+            with self.lock:
+                self.stats['requests'] += 1
+            for reuse in (True, False):
+                self.local.reuse = reuse
+                self.local.connection = None
+                self.local.reused = False
+                try:
+                    response = atom.http.ProxiedHttpClient.request(self,
+                        operation, url, data=data, headers=headers)
+                except (socket.error, httplib.HTTPException) as err:
+                    if self.local.connection is not None:
+                        self.local.connection.close()
+                    if not self.local.reused:
+                        raise
+                    with self.lock:
+                        self.stats['reused'] -= 1
+                        self.stats['stale'] += 1
+                    LOG.debug("Reused connection failed, {reason}.".format(
+                        reason=str(err) or err.__class__.__name__))
+                    continue
+                return self.release(response)
+
+
+def map_concurrent(func, items, workers=1):
+    """Call a function for each item using a pool of worker threads.
+    Args:
+        func: function accepting a single item
+        items: list of items
+        workers: integer, maximum number of concurrent calls
+    Returns:
+        list of (result, error) tuples in the order of items. The error is
+        None if the call succeeded, otherwise a string describing the
+        gdata.service.RequestError raised.
+
+    Notes:
+        Any other exception raised by a call is re-raised once all workers
+        have finished.
+    """
+    results = [(None, None)] * len(items)
+    unexpected = []
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        """Process items until the queue is empty."""
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (func(item), None)
+            except gdata.service.RequestError as err:
+                e = err.args[0]
+                results[index] = (None, 'Status: {status}, {reason}'.format(
+                    status=e['status'], reason=e['reason']))
+            # W0703: *Catch "Exception"*
+            # pylint: disable=W0703
+            except Exception:
+                unexpected.append(sys.exc_info())
+
+    if workers <= 1 or len(items) <= 1:
+        worker()
+    else:
+        threads = []
+        for unused_count in range(min(workers, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    if unexpected:
+        raise unexpected[0][0], unexpected[0][1], unexpected[0][2]
+    return results
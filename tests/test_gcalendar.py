@@ -0,0 +1,504 @@
+#!/usr/bin/python
+
+"""
+Tests of gcalendar.py.
+
+Google is replaced by stub http clients and local stand in servers. To run,
+from the repository root:
+
+    python -m unittest discover tests
+
+"""
+
+import cgi
+import imp
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+import urlparse
+
+sys.dont_write_bytecode = True
+BIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BIN_DIR)
+gcalendar = imp.load_source('gcalendar', os.path.join(BIN_DIR,
+    'gcalendar.py'))
+gcalendar.import_modules()
+# W0404: *Reimport %r (imported line %s)*
+# pylint: disable=W0404
+import atom
+import gdata
+import gdata.calendar
+import gservice
+
+FEED_URI = 'http://www.google.com/calendar/feeds/default/private/full'
+# Run gcalendar.py as a script and print the gdata and atom modules loaded.
+RUN_SCRIPT = """
+import runpy
+import sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print sorted(x for x in sys.modules if x.split('.')[0] in ('atom', 'gdata'))
+"""
+
+
+def make_entry(event_id, what='Event', start='2011-06-13T09:00:00.000Z',
+        end='2011-06-13T10:00:00.000Z'):
+    """Return a CalendarEventEntry."""
+    entry = gdata.calendar.CalendarEventEntry()
+    entry.id = atom.Id(text='{uri}/{id}'.format(uri=FEED_URI, id=event_id))
+    entry.title = atom.Title(text=what)
+    entry.content = atom.Content()
+    entry.when = [gdata.calendar.When(start_time=start, end_time=end)]
+    entry.link.append(atom.Link(rel='edit', href='{uri}/{id}/1'.format(
+        uri=FEED_URI, id=event_id)))
+    return entry
+
+
+class StubResponse():
+    """Class representing a canned http response."""
+    def __init__(self, status, body='', headers=None, reason=''):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        """Return the value of a header."""
+        return self.headers.get(name, default)
+
+    def read(self):
+        """Return the body."""
+        body = self.body
+        self.body = ''
+        return body
+
+
+class StubHttpClient():
+    """Class representing an http client replying with canned responses.
+
+    The requests property lists the (operation, url, data, headers) of each
+    request received.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, operation, url, data=None, headers=None):
+        """Record the request and return the next response."""
+        self.requests.append((operation, str(url), data, headers or {}))
+        return self.responses.pop(0)
+
+
+class FeedHttpClient():
+    """Class representing an http client serving pages of a feed.
+
+    The requests property lists the start-index of each page requested.
+    """
+    def __init__(self, count, total=True):
+        self.entries = [make_entry('ev{i}'.format(i=x)) for x in range(count)]
+        self.total = total      # If True, pages have openSearch:totalResults
+        self.requests = []
+
+    def request(self, operation, url, data=None, headers=None):
+        """Return the page of the feed requested."""
+        # W0613: *Unused argument %r*
+        # pylint: disable=W0613
+        params = cgi.parse_qs(urlparse.urlparse(str(url)).query)
+        start = int(params['start-index'][0])
+        size = int(params['max-results'][0])
+        self.requests.append(start)
+        feed = gdata.calendar.CalendarEventFeed(
+            entry=self.entries[start - 1:start - 1 + size])
+        if self.total:
+            feed.total_results = gdata.TotalResults(
+                text=str(len(self.entries)))
+        return StubResponse(200, feed.ToString())
+
+
+def stub_calendar(responses):
+    """Return a Calendar whose client replies with the responses."""
+    gd_client = gcalendar.CalendarService(http_client=StubHttpClient(
+        responses), governor=gservice.Governor(max_rate=0))
+    calendar = gcalendar.Calendar(gd_client=gd_client)
+    for event_id in ('ev1', 'ev2'):
+        calendar.events.add(gcalendar.Event(entry=make_entry(event_id)))
+    return calendar
+
+
+class TestBatch(unittest.TestCase):
+    """Test batch requests, Calendar.update_batch()."""
+    blocks = [
+        ['what: New event', 'when: 2011-06-14 09:00:00'],
+        ['id: ev1', 'what: Renamed'],
+        ['id: ev2', 'what: DELETE'],
+        ]
+
+    def test_statuses(self):
+        """Each block gets the status of its entry in the batch reply."""
+        reply = gdata.calendar.CalendarEventFeed()
+        inserted = make_entry('new1', what='New event')
+        inserted.batch_id = gdata.BatchId(text='0')
+        inserted.batch_status = gdata.BatchStatus(code='201',
+            reason='Created')
+        conflict = gdata.calendar.CalendarEventEntry()
+        conflict.batch_id = gdata.BatchId(text='1')
+        conflict.batch_status = gdata.BatchStatus(code='409',
+            reason='Conflict')
+        reply.entry = [conflict, inserted]
+        calendar = stub_calendar([StubResponse(200, reply.ToString())])
+        results = calendar.update_batch(self.blocks, batch_size=10)
+
+        requests = calendar.gd_client.http_client.requests
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0][0], 'POST')
+        self.assertTrue(requests[0][1].endswith('/private/full/batch'))
+
+        result, error = results[0]
+        self.assertEqual(error, None)
+        self.assertEqual(gcalendar.entry_id(result), 'new1')
+        self.assertTrue(calendar.find_event('new1'))
+        self.assertEqual(results[1], (None, 'Status: 409, Conflict'))
+        # No status for the delete, the event is kept.
+        self.assertEqual(results[2], (None, 'No batch status returned.'))
+        self.assertTrue(calendar.find_event('ev2'))
+
+    def test_failed_request(self):
+        """If the batch request fails, every block in it fails."""
+        calendar = stub_calendar([StubResponse(500, 'Server error',
+            reason='Internal Server Error')])
+        results = calendar.update_batch(self.blocks, batch_size=10)
+        self.assertEqual(len(results), 3)
+        for result, error in results:
+            self.assertEqual(result, None)
+            self.assertTrue('500' in str(error))
+        self.assertTrue(calendar.find_event('ev2'))
+
+    def test_batch_size(self):
+        """Operations are split into batches of batch_size."""
+        replies = [StubResponse(200, gdata.calendar.CalendarEventFeed(
+            ).ToString()) for unused in range(2)]
+        calendar = stub_calendar(replies)
+        results = calendar.update_batch(self.blocks, batch_size=2)
+        self.assertEqual(len(calendar.gd_client.http_client.requests), 2)
+        self.assertEqual(results, [(None, 'No batch status returned.')] * 3)
+
+
+class TestDaemon(unittest.TestCase):
+    """Test serving queries, Daemon.handle()."""
+    def setUp(self):
+        calendar = gcalendar.Calendar(cache=gcalendar.EventCache())
+        for event_id, what in (('ev1', 'Caf\xc3\xa9'), ('ev2', 'Dentist')):
+            calendar.events.add(gcalendar.Event(entry=make_entry(event_id,
+                what=what)))
+        calendar.events.build_time_index()
+        calendar.resident = True
+        self.daemon = gcalendar.Daemon(None, 'a@b.c')
+        self.daemon.calendars['default'] = calendar
+
+    def query(self, argv):
+        """Send argv to the daemon and return the lines of its reply."""
+        client, server = socket.socketpair()
+        client.sendall(json.dumps(argv) + '\n')
+        self.daemon.handle(server)
+        reply = client.makefile('rb').read()
+        client.close()
+        return reply.splitlines()
+
+    def test_non_ascii(self):
+        """A non-ASCII keyword is matched, not refused."""
+        lines = self.query(['-m', 'short', '-f', '2011-01-01',
+            'caf\xc3\xa9'])
+        self.assertEqual(lines[0], 'ok')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue('Caf\xc3\xa9' in lines[1])
+
+    def test_fallback(self):
+        """Queries the daemon does not serve are sent back."""
+        self.assertEqual(self.query(['--edit']), ['fallback'])
+
+
+class TestFilter(unittest.TestCase):
+    """Test keyword matching, Calendar.filter()."""
+    def setUp(self):
+        dentist = make_entry('ev1', what='Dentist')
+        office = make_entry('ev2', what='Checkup')
+        office.where = [gdata.calendar.Where(value_string='Dentist office')]
+        self.events = [gcalendar.Event(entry=dentist),
+            gcalendar.Event(entry=office)]
+
+    def ids(self, keyword, **kwargs):
+        """Return the ids of the events matching the keyword."""
+        calendar = gcalendar.Calendar()
+        return [x.id for x in calendar.filter(self.events, keyword=keyword,
+            **kwargs)]
+
+    def test_default(self):
+        """By default the keyword is a regex searched for in the what and
+        description."""
+        self.assertEqual(self.ids('entist'), ['ev1'])
+        self.assertEqual(self.ids('^dent'), ['ev1'])
+        self.assertEqual(self.ids('office'), [])
+
+    def test_query(self):
+        """The query syntax matches words in the what, description and
+        where."""
+        self.assertEqual(self.ids('entist', match='prefix'), [])
+        self.assertEqual(self.ids('dent', match='prefix'), ['ev1', 'ev2'])
+        self.assertEqual(self.ids('dent', match='word'), [])
+
+
+class TestLogin(unittest.TestCase):
+    """Test logging in with a cached auth token."""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rejected_token(self):
+        """A rejected token is removed even if logging in again fails."""
+        token_cache = gservice.TokenCache(filename=os.path.join(
+            self.tmp_dir, 'a@b.c.token'))
+        token_cache.save('stale')
+        gd_client = gcalendar.CalendarService(token_cache=token_cache,
+            http_client=StubHttpClient([
+                StubResponse(401, reason='Unauthorized'),
+                StubResponse(403, 'Error=BadAuthentication\n',
+                    reason='Forbidden')]),
+            governor=gservice.Governor(max_rate=0))
+        gd_client.email = 'a@b.c'
+        gd_client.password = 'secret'
+        gd_client.login()
+        self.assertTrue(gd_client.cached_token)
+        self.assertRaises(gdata.service.BadAuthentication, gd_client.Get,
+            FEED_URI)
+        self.assertEqual(token_cache.load(), None)
+        self.assertFalse(os.path.exists(token_cache.filename))
+
+
+class TestOrdered(unittest.TestCase):
+    """Test the order events are printed in, Calendar.ordered()."""
+    def test_untimed_last(self):
+        """Streamed events without a start time are last, by id."""
+        events = []
+        for event_id, start in (('ev1', '2011-06-13T09:00:00.000Z'),
+                ('ev4', None), ('ev2', '2011-06-14T09:00:00.000Z'),
+                ('ev3', None)):
+            entry = make_entry(event_id, start=start)
+            if not start:
+                entry.when = []
+            events.append(gcalendar.Event(entry=entry))
+        calendar = gcalendar.Calendar()
+        self.assertEqual([x.id for x in calendar.ordered(iter(events))],
+            ['ev1', 'ev2', 'ev3', 'ev4'])
+        self.assertEqual([x.id for x in calendar.ordered(iter(events),
+            limit=3)], ['ev1', 'ev2', 'ev3'])
+        self.assertEqual([x.id for x in calendar.ordered(iter(events),
+            sort_by='id', limit=2)], ['ev1', 'ev2'])
+
+
+class TestPages(unittest.TestCase):
+    """Test the pages of feeds requested, Calendar.feed_entries()."""
+    def events(self, http_client, detached=True):
+        """Return the ids of the events of the feed."""
+        gd_client = gcalendar.CalendarService(http_client=http_client,
+            governor=gservice.Governor(max_rate=0))
+        calendar = gcalendar.Calendar(gd_client=gd_client)
+        calendar.detached = detached
+        return [x.id for x in calendar.get()]
+
+    def test_total(self):
+        """Only the pages within the total are requested."""
+        for detached in (True, False):
+            http_client = FeedHttpClient(601)
+            self.assertEqual(len(self.events(http_client, detached)), 601)
+            self.assertEqual(sorted(http_client.requests), [1, 251, 501])
+        http_client = FeedHttpClient(500)
+        self.assertEqual(len(self.events(http_client)), 500)
+        self.assertEqual(http_client.requests, [1, 251])
+
+    def test_no_total(self):
+        """Without a total, pages past a short page are not requested."""
+        http_client = FeedHttpClient(601, total=False)
+        self.assertEqual(self.events(http_client)[-1], 'ev600')
+        self.assertEqual(sorted(http_client.requests)[:3], [1, 251, 501])
+        # At most the pages already started when the short page arrived,
+        # page_workers after the first page.
+        self.assertTrue(len(http_client.requests) <=
+            1 + gcalendar.PAGE_WORKERS)
+
+
+class TestRecurring(unittest.TestCase):
+    """Test recurring events in the cache and time index."""
+    def test_between(self):
+        """Events without a start time are only in an unlimited range."""
+        untimed = gcalendar.Event(entry=make_entry('ev3', start=None,
+            end=None))
+        untimed.entry.when = []
+        store = gcalendar.EventStore([gcalendar.Event(entry=make_entry(
+            'ev1')), untimed])
+        self.assertEqual([x.id for x in store.between()], ['ev1', 'ev3'])
+        self.assertEqual([x.id for x in store.between(
+            start='2011-06-01 00:00:00')], ['ev1'])
+        self.assertEqual([x.id for x in store.between(
+            end='2011-06-01 00:00:00')], [])
+
+    def test_sync_expansion(self):
+        """Syncs request occurrences of recurring events in a window, and
+        a query outside the window fetches all events again."""
+        feed = gdata.calendar.CalendarEventFeed(entry=[make_entry('ev1')])
+        feed.updated = atom.Updated(text='2011-06-01T00:00:00.000Z')
+        calendar = stub_calendar([StubResponse(200, feed.ToString())
+            for unused in range(3)])
+        calendar.cache = gcalendar.EventCache()
+        calendar.set_query_filters()
+        calendar.sync()
+        start, end = calendar.cache.expansion
+        self.assertTrue(start < calendar.from_time[:10] < end)
+        calendar.sync()
+        calendar.set_query_filters(from_date='1999-01-01')
+        calendar.sync()
+        self.assertEqual(calendar.cache.expansion[0], '1999-01-01')
+
+        uris = [x[1] for x in calendar.gd_client.http_client.requests]
+        for uri in uris:
+            self.assertTrue('singleevents=true' in uri)
+        self.assertTrue('recurrence-expansion-start={date}'.format(
+            date=start) in uris[0])
+        self.assertTrue('updated-min' in uris[1])
+        self.assertTrue('updated-min' not in uris[2])
+        self.assertTrue('recurrence-expansion-start=1999-01-01' in uris[2])
+
+
+class TestRefresh(unittest.TestCase):
+    """Test refreshing and updating events by etag."""
+    def setUp(self):
+        self.calendar = stub_calendar([])
+        self.event = self.calendar.find_event('ev1')
+        self.set_etag(self.event.entry, 'W/"e1"')
+
+    def requests(self):
+        """Return the (operation, headers) of the requests sent."""
+        return [(x[0], x[3]) for x in
+            self.calendar.gd_client.http_client.requests]
+
+    def set_etag(self, entry, etag):
+        """Set the gd:etag of an entry."""
+        # R0201: *Method could be a function*
+        # pylint: disable=R0201
+        entry.extension_attributes[gcalendar.GD_NS + 'etag'] = etag
+
+    def test_refresh(self):
+        """A changed event is replaced, then its etag gets a 304 reply."""
+        current = make_entry('ev1', what='Changed')
+        self.set_etag(current, 'W/"e2"')
+        self.calendar.gd_client.http_client.responses = [
+            StubResponse(200, current.ToString()),
+            StubResponse(304, reason='Not Modified')]
+        refreshed = self.calendar.refresh_event(self.event)
+        self.assertEqual(refreshed.what, 'Changed')
+        self.assertEqual(gcalendar.entry_etag(refreshed.entry), 'W/"e2"')
+        self.assertTrue(self.calendar.find_event('ev1') is refreshed)
+        self.assertTrue(self.calendar.refresh_event(refreshed) is refreshed)
+
+        requests = self.requests()
+        self.assertEqual([x[0] for x in requests], ['GET', 'GET'])
+        self.assertEqual([x[1]['If-None-Match'] for x in requests],
+            ['W/"e1"', 'W/"e2"'])
+        for unused, headers in requests:
+            self.assertEqual(headers['GData-Version'], '2')
+
+    def test_sync(self):
+        """Synced entries keep their etags in the cache."""
+        entry = make_entry('ev3')
+        entry.id = atom.Id(
+            text='http://www.google.com/calendar/feeds/default/events/ev3')
+        self.set_etag(entry, 'W/"e3"')
+        feed = gdata.calendar.CalendarEventFeed(entry=[entry])
+        feed.updated = atom.Updated(text='2011-06-01T00:00:00.000Z')
+        self.calendar.gd_client.http_client.responses = [
+            StubResponse(200, feed.ToString())]
+        self.calendar.cache = gcalendar.EventCache()
+        self.calendar.set_query_filters()
+        self.calendar.sync()
+        self.calendar.load_events()
+        event = self.calendar.find_event('ev3')
+        self.assertEqual(gcalendar.entry_etag(event.entry), 'W/"e3"')
+        self.assertEqual(self.requests()[0][1]['GData-Version'], '2')
+
+    def test_update_conflict(self):
+        """An update of a changed event is applied to the current version."""
+        current = make_entry('ev1', what='Changed')
+        self.set_etag(current, 'W/"e2"')
+        updated = make_entry('ev1', what='Renamed')
+        self.set_etag(updated, 'W/"e3"')
+        self.calendar.gd_client.http_client.responses = [
+            StubResponse(412, reason='Precondition Failed'),
+            StubResponse(200, current.ToString()),
+            StubResponse(200, updated.ToString())]
+        result = self.calendar.update_event(['id: ev1', 'what: Renamed'])
+        self.assertEqual(result.title.text, 'Renamed')
+        self.assertEqual(gcalendar.entry_etag(result), 'W/"e3"')
+
+        requests = self.requests()
+        self.assertEqual([x[0] for x in requests], ['PUT', 'GET', 'PUT'])
+        self.assertEqual(requests[0][1]['If-Match'], 'W/"e1"')
+        self.assertEqual(requests[1][1]['If-None-Match'], 'W/"e1"')
+        self.assertEqual(requests[2][1]['If-Match'], 'W/"e2"')
+        for unused, headers in requests:
+            self.assertEqual(headers['GData-Version'], '2')
+
+
+class TestStartup(unittest.TestCase):
+    """Test which paths start without importing gdata."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def run_script(self, *args):
+        """Run gcalendar.py and return its output and the gdata and atom
+        modules it imported."""
+        env = dict(os.environ, HOME=self.home)
+        env['PYTHONPATH'] = os.pathsep.join([BIN_DIR] + sys.path)
+        process = subprocess.Popen([sys.executable, '-c', RUN_SCRIPT,
+            os.path.join(BIN_DIR, 'gcalendar.py')] + list(args), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual(err, '')
+        output, modules = out.rstrip('\n').rsplit('\n', 1)
+        return (output, eval(modules))
+
+    def test_help(self):
+        """--help does not import gdata."""
+        output, modules = self.run_script('--help')
+        self.assertTrue('--offline' in output)
+        self.assertEqual(modules, [])
+
+    def test_offline(self):
+        """Queries of the cache with --offline do not import gdata."""
+        cache = gcalendar.EventCache(filename=os.path.join(self.home,
+            '.cache', 'gcalendar', 'a@b.c.events'))
+        cache.merge([make_entry('ev1', what='Dentist'),
+            make_entry('ev2', what='Hockey', start='2011-06-20T19:00:00Z',
+                end='2011-06-20T20:00:00Z')])
+        cache.synced = '2011-06-01T00:00:00.000Z'
+        cache.expansion = ('2011-01-01', '2011-12-31')
+        cache.save()
+        output, modules = self.run_script('--offline', '-a', 'a@b.c', '-m',
+            'short', '-f', '2011-06-01', '-t', '2011-06-30', 'dent')
+        self.assertEqual(output.split('\t')[1], 'Dentist')
+        self.assertEqual(modules, [])
+
+
+if __name__ == '__main__':
+    unittest.main()